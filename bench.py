@@ -0,0 +1,70 @@
+"""
+Run the benchmarks and print the results as JSON.
+
+python bench.py [-o results.json] [--compare previous.json]
+"""
+import sys
+import json
+import platform
+import argparse
+import lxml.etree
+import coucheventjoiner
+from benchmarks import (bench_parsing, bench_polling, bench_startup, 
+                        bench_memory)
+
+SUITES = [bench_parsing, bench_polling, bench_startup, bench_memory]
+#compared values of the results: key, unit, scale
+MEASURES = [('best', 'ms', 1000), ('polled_bytes_per_event', 'bytes', 1)]
+
+def compare(results, previous, tolerance):
+    """
+    Returns:
+    list of str: benchmarks slower than in previous by more than tolerance
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        before = previous.get(name, {})
+        for (key, unit, scale) in MEASURES:
+            if (key in result and key in before and 
+                result[key] > before[key] * (1 + tolerance)):
+                regressions.append("{0}: {1:.3f} {3} -> {2:.3f} {3}".format(
+                    name, before[key] * scale, result[key] * scale, unit))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmarks')
+    parser.add_argument('-o', '--output', help='Write the JSON results there')
+    parser.add_argument('-c', '--compare', 
+                        help='JSON results of a previous run. Exit with an '
+                             'error if a benchmark got slower')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='Slowdown tolerated by --compare (default 0.2)')
+    parser.add_argument('-k', '--only', 
+                        help='Only run benchmarks whose name contains ONLY')
+    args = parser.parse_args()
+
+    results = {}
+    for suite in SUITES:
+        results.update(suite.run(args.only))
+    report = {'version': coucheventjoiner.__version__,
+              'python': platform.python_version(),
+              'lxml': lxml.etree.__version__,
+              'results': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+        regressions = compare(results, previous, args.tolerance)
+        for regression in regressions:
+            sys.stderr.write("slower: {0}\n".format(regression))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmarks of the hot paths of coucheventjoiner.
+
+Run them with bench.py from the main directory.
+"""
+import os
+import re
+import gc
+import timeit
+import collections
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                            '..', 
+                            'tests')
+EVENT_URL = 'https://www.couchsurfing.org/n/events/eventname'
+
+def fixture(name):
+    """Content of one of the saved event pages of the tests"""
+    with open(os.path.join(FIXTURES_DIR, name)) as f:
+        return f.read()
+
+def synthetic_event_page(attendees, capacity=None):
+    """
+    Event page with the given number of attendees, built from a saved page.
+
+    Args:
+    capacity (int): number of spots. Default: attendees (event full)
+    """
+    page = fixture('event_logged_full_notjoined.html')
+    capacity = attendees if capacity is None else capacity
+    items = re.findall(r'<li class="event_user_list_item.*?</li>', page)
+    start = page.index(items[0])
+    end = page.index(items[-1]) + len(items[-1])
+    repeated = (items * (attendees // len(items) + 1))[:attendees]
+    page = page[:start] + '\n'.join(repeated) + page[end:]
+    return page.replace(
+        "<span class='attendee_count'>20</span><span> Attending out of 20",
+        "<span class='attendee_count'>{0}</span><span> Attending out of {1}"
+            .format(attendees, capacity),
+        1)
+
+def selected(name, only):
+    """
+    Returns:
+    bool: the benchmark name must run when only those containing only do
+    """
+    return only is None or only in name
+
+#a measure lasts at least that long (seconds)
+MIN_MEASURE_TIME = 0.05
+
+def timed(function, repeat=3, number=None):
+    """
+    Time function.
+
+    Args:
+    number (int): calls per measure. Default: enough calls for a measure to 
+        last MIN_MEASURE_TIME
+
+    Returns:
+    dict: seconds per call (best and median of repeat measures) and calls
+    """
+    timer = timeit.Timer(function)
+    if number is None:
+        for number in (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10 ** 4):
+            if timer.timeit(number) >= MIN_MEASURE_TIME:
+                break
+    gc.collect()
+    measures = sorted(t / number for t in timer.repeat(repeat, number))
+    return {'best': measures[0],
+            'median': measures[len(measures) // 2],
+            'calls': number * repeat}
+
+def session_manager(*routes):
+    """
+    tests.helpers.session_manager, without the list of the requests sent:
+    it would grow with every benchmarked call and be counted as memory.
+
+    Args:
+    routes: (method, URL regular expression, answer), see 
+        coucheventjoiner.FakeAdapter
+
+    Returns:
+    coucheventjoiner.SessionManager
+    """
+    #not at the top: the tests import the benchmarks from their directory,
+    #where tests is tests.py
+    from tests import helpers
+    manager = helpers.session_manager(*routes)
+    manager.session.get_adapter(EVENT_URL).sent = collections.deque(maxlen=1)
+    return manager
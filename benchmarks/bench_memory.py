@@ -0,0 +1,90 @@
+"""
+Memory used per watched event: many events are watched, each one is polled
+once against canned responses, and the growth of the resident memory is 
+divided by the number of events.
+
+python -m benchmarks.bench_memory [--events 10000]
+
+Measured in a new interpreter so that earlier benchmarks don't leave memory
+around to be reused. Linux only: the resident memory is read in /proc. Pages
+are streamed: the memory kept after a poll is the same without streaming, 
+parsing whole pages would only make the benchmark slower.
+"""
+import os
+import gc
+import sys
+import json
+import argparse
+import subprocess
+import coucheventjoiner
+from benchmarks import EVENT_URL, fixture, selected, session_manager
+
+DEFAULT_EVENTS = 10000
+
+def resident_memory():
+    """
+    Returns:
+    int: bytes of resident memory of the process
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def measure(events):
+    """
+    Returns:
+    dict: bytes per event once the watchers are created and once every 
+        event has been polled
+    """
+    #every event gets the same page
+    page = {'content': fixture('event_logged_full_notjoined.html')}
+    join = {'content': '{"error":"This event is full."}'}
+    manager = session_manager(('GET', '.*', page), ('POST', '.*', join))
+    #first poll outside of the measure: imports, compiled XPaths...
+    watch = coucheventjoiner.watch_event(manager, EVENT_URL + 'warmup', 10, 
+                                         stream=True)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        next(watch)
+        gc.collect()
+        start = resident_memory()
+        scheduler = coucheventjoiner.Scheduler()
+        for i in xrange(events):
+            event = '{0}{1}'.format(EVENT_URL, i)
+            scheduler.add(event, 
+                          coucheventjoiner.watch_event(manager, event, 10, 
+                                                       stream=True))
+        gc.collect()
+        created = resident_memory()
+        for _ in xrange(events):
+            scheduler.run_once()
+        gc.collect()
+        polled = resident_memory()
+    finally:
+        sys.stdout = stdout
+    return {'events': events,
+            'created_bytes_per_event': (created - start) / events,
+            'polled_bytes_per_event': (polled - start) / events}
+
+def run(only=None, events=DEFAULT_EVENTS):
+    """
+    Args:
+    only (str): only run the benchmark if its name contains it
+    """
+    if not selected('memory/watched_event', only):
+        return {}
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'benchmarks.bench_memory', 
+         '--events', str(events)],
+        cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    return {'memory/watched_event': json.loads(output)}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Memory used per watched event')
+    parser.add_argument('--events', type=int, default=DEFAULT_EVENTS)
+    args = parser.parse_args()
+    print json.dumps(measure(args.events))
+
+if __name__ == '__main__':
+    main()
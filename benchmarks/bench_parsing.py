@@ -0,0 +1,62 @@
+"""
+Parsing of event pages: lxml.html.fromstring, each check and the 
+EventPageState extraction on the saved pages and on synthetic pages with many
+attendees.
+"""
+import lxml.html
+import coucheventjoiner
+from benchmarks import fixture, synthetic_event_page, timed, selected
+
+FIXTURES = ['event_logged_freespot_notjoined.html',
+            'event_logged_full_notjoined.html',
+            'event_unlogged_past_nospotlimit.html',
+            'event_attending_over.html']
+SYNTHETIC_ATTENDEES = [100, 1000, 5000]
+
+CHECKS = [('is_logged_in', coucheventjoiner.is_logged_in),
+          ('is_event_over', coucheventjoiner.is_event_over),
+          ('is_attending', coucheventjoiner.is_attending),
+          ('is_event_full', coucheventjoiner.is_event_full),
+          ('extract_event_state', coucheventjoiner.extract_event_state)]
+
+def page_selected(name, only):
+    """
+    Returns:
+    bool: a benchmark of the page name must run
+    """
+    return any(selected(name + '/' + benchmark, only) 
+               for benchmark in (['fromstring', 'stream'] + 
+                                 [check_name for (check_name, _) in CHECKS]))
+
+def bench_page(name, content, only=None):
+    results = {}
+    if selected(name + '/fromstring', only):
+        results[name + '/fromstring'] = timed(
+            lambda: lxml.html.fromstring(content))
+    tree = lxml.html.fromstring(content)
+    for (check_name, check) in CHECKS:
+        if selected(name + '/' + check_name, only):
+            results[name + '/' + check_name] = timed(lambda: check(tree))
+    if selected(name + '/stream', only):
+        results[name + '/stream'] = timed(
+            lambda: coucheventjoiner.parse_event_page_stream(
+                content[i:i + coucheventjoiner.STREAM_CHUNK_SIZE] 
+                for i in xrange(0, len(content), coucheventjoiner.STREAM_CHUNK_SIZE)))
+    return results
+
+def run(only=None):
+    """
+    Args:
+    only (str): only run the benchmarks whose name contains it
+    """
+    results = {}
+    for name in FIXTURES:
+        if page_selected(name, only):
+            results.update(bench_page(name, fixture(name), only))
+    for attendees in SYNTHETIC_ATTENDEES:
+        name = 'synthetic_{0}'.format(attendees)
+        if page_selected(name, only):
+            results.update(bench_page(name, 
+                                      synthetic_event_page(attendees),
+                                      only))
+    return results
@@ -0,0 +1,51 @@
+"""
+One polling iteration (EventWatch.poll) against canned responses: the whole 
+path from the request to the decision, without network.
+"""
+import re
+import coucheventjoiner
+from benchmarks import EVENT_URL, fixture, timed, selected, session_manager
+
+def full_event_watch(stream=False, probe_every=None, etag=None):
+    """
+    Args:
+    etag (str): sent with the page, which is then answered 304 to the 
+        requests giving it back in If-None-Match
+    """
+    full = {'content': fixture('event_logged_full_notjoined.html'),
+            'headers': {'ETag': etag} if etag else {}}
+    def page(request):
+        if etag and request.headers.get('If-None-Match') == etag:
+            return {'status_code': 304}
+        return full
+    join = {'content': '{"error":"This event is full."}'}
+    manager = session_manager(('GET', re.escape(EVENT_URL), page),
+                              ('POST', re.escape(EVENT_URL + '/join'), join))
+    return coucheventjoiner.EventWatch(manager, 
+                                       EVENT_URL, 
+                                       coucheventjoiner.FixedDelay(10),
+                                       stream,
+                                       probe_every)
+
+def poll_without_cache():
+    watch = full_event_watch()
+    watch.poll()
+
+#every poll retrieves the same page: parsed once, then hash hit
+BENCHMARKS = [('poll/full_event', lambda: full_event_watch().poll),
+              ('poll/full_event_stream', 
+               lambda: full_event_watch(stream=True).poll),
+              ('poll/full_event_probe', 
+               lambda: full_event_watch(probe_every=10 ** 9).poll),
+              #the page is retrieved once, then not modified
+              ('poll/full_event_304', 
+               lambda: full_event_watch(etag='"v1"').poll),
+              ('poll/full_event_cold', lambda: poll_without_cache)]
+
+def run(only=None):
+    """
+    Args:
+    only (str): only run the benchmarks whose name contains it
+    """
+    return dict((name, timed(make())) for (name, make) in BENCHMARKS
+                if selected(name, only))
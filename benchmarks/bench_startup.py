@@ -0,0 +1,53 @@
+"""
+Cold start of the command line: a new interpreter imports coucheventjoiner,
+parses and validates the arguments, as when run from cron or a wrapper.
+"""
+import os
+import sys
+import subprocess
+from benchmarks import EVENT_URL, timed, selected
+
+MAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#run in the new interpreter. Stops where main would start logging in
+STARTUP = '''
+import sys
+sys.argv = ['coucheventjoiner.py'] + sys.argv[1:]
+import coucheventjoiner
+try:
+    coucheventjoiner.get_user_values()
+except SystemExit:
+    pass
+'''
+
+#name -> command line arguments
+MODES = {'help': ['--help'],
+         'invalid_url': ['https://www.couchsurfing.org/n/places/x', 
+                         'username', 'password'],
+         'one_event': [EVENT_URL, 'username', 'password'],
+         'many_events': ['-m', '300', '-b', '60', 
+                         '-e', EVENT_URL + '2', '-e', EVENT_URL + '3', 
+                         EVENT_URL, 'username', 'password'],
+         'daemon': ['--daemon', '--state-db', 'watches.db', 
+                    EVENT_URL, 'username', 'password']}
+
+def run_python(args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([sys.executable] + args, 
+                        cwd=MAIN_DIR, 
+                        stdout=devnull, 
+                        stderr=devnull)
+
+def run(only=None):
+    """
+    Args:
+    only (str): only run the benchmarks whose name contains it
+    """
+    #what every mode pays before coucheventjoiner is imported
+    commands = [('startup/interpreter', ['-c', 'pass']),
+                ('startup/import', ['-c', 'import coucheventjoiner'])]
+    commands.extend(('startup/' + mode, ['-c', STARTUP] + args)
+                    for (mode, args) in MODES.items())
+    return dict((name, timed(lambda args=args: run_python(args)))
+                for (name, args) in commands
+                if selected(name, only))
@@ -0,0 +1,194 @@
+"""
+Load test: watch many simulated events on the stand-in server and measure 
+throughput, time to join and CPU use.
+
+python -m benchmarks.load --events 1000 --delay 1 --duration 60 --churn 0.01
+
+The stand-in server runs in another process so that the CPU time reported is
+the one of the watchers only. Results are printed as JSON.
+"""
+import os
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+import requests
+import coucheventjoiner
+from benchmarks import standin
+
+def _serve(state_kwargs, connection):
+    server = standin.StandinServer(('127.0.0.1', 0), 
+                                   standin.StandinState(**state_kwargs))
+    connection.send(server.url)
+    server.serve_forever()
+
+def start_standin_process(**state_kwargs):
+    """
+    Returns:
+    (multiprocessing.Process, str): process of the server and its URL
+    """
+    (parent, child) = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, args=(state_kwargs, child))
+    process.daemon = True
+    process.start()
+    return (process, parent.recv())
+
+#watchers are polled from several threads with --workers
+_counter_lock = threading.Lock()
+
+def counted_watch(watch, counter):
+    """Like watch_event, without printing and counting the polls"""
+    try:
+        while True:
+            (result, _) = watch.poll()
+            with _counter_lock:
+                counter['polls'] += 1
+                counter[result.name] = counter.get(result.name, 0) + 1
+            if result != coucheventjoiner.Result.retry:
+                return
+            yield watch.next_delay()
+    finally:
+        watch.close()
+
+def run(url, events, delay, duration, max_delay=None, stream=False, 
+        probe_every=None, pool_size=10, workers=1, parse_processes=None):
+    """
+    Watch events simulated events of the stand-in server at url.
+
+    Args:
+    workers (int): polls run at the same time. 1 polls from the main thread
+    parse_processes (int): parse the pages in a ParserPool of that many 
+        processes
+
+    Returns:
+    dict: measures of the client side
+    """
+    if parse_processes:
+        coucheventjoiner.parser_pool = coucheventjoiner.ParserPool(
+            parse_processes)
+    try:
+        session = standin.standin_session(url, pool_maxsize=pool_size)
+        manager = coucheventjoiner.SessionManager(session, 
+                                                  'loadtest', 
+                                                  'password')
+        manager.login()
+        urls = ['https://{0}{1}load{2}'.format(
+                coucheventjoiner.COUCHSURFING_NETLOC,
+                coucheventjoiner.COUCHSURFING_EVENT_BASE_PATH,
+                i) for i in xrange(events)]
+        result = measure(manager,
+                         urls,
+                         delay, 
+                         duration, 
+                         max_delay, 
+                         stream, 
+                         probe_every, 
+                         workers)
+    finally:
+        if parse_processes:
+            coucheventjoiner.parser_pool.close()
+            coucheventjoiner.parser_pool = None
+    result['parse_processes'] = parse_processes
+    return result
+
+def measure(manager, events, delay, duration, max_delay=None, stream=False, 
+            probe_every=None, workers=1):
+    """
+    Watch the event URLs of events with the session of manager for duration
+    seconds at most.
+
+    Returns:
+    dict: measures of the client side
+    """
+    counter = {'polls': 0}
+    if workers > 1:
+        scheduler = coucheventjoiner.ConcurrentScheduler(workers)
+    else:
+        scheduler = coucheventjoiner.Scheduler()
+    for event in events:
+        watch = coucheventjoiner.EventWatch(
+            manager, 
+            event, 
+            coucheventjoiner.make_delay(delay, max_delay),
+            stream,
+            probe_every)
+        scheduler.add(event, counted_watch(watch, counter))
+
+    start_cpu = os.times()
+    start = time.time()
+    try:
+        while len(scheduler) and time.time() - start < duration:
+            scheduler.run_once()
+    finally:
+        if workers > 1:
+            scheduler.close()
+    elapsed = time.time() - start
+    end_cpu = os.times()
+    cpu = (end_cpu[0] - start_cpu[0]) + (end_cpu[1] - start_cpu[1])
+    return {'events': len(events),
+            'workers': workers,
+            'elapsed': elapsed,
+            'polls': counter['polls'],
+            'polls_per_second': counter['polls'] / elapsed,
+            'results': dict((name, count) for (name, count) in counter.items()
+                            if name != 'polls'),
+            'cpu_seconds': cpu,
+            'cpu_ms_per_poll': 1000 * cpu / max(counter['polls'], 1),
+            'logins_last_hour': manager.logins_last_hour(),
+            'still_watching': len(scheduler)}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test against the couchsurfing stand-in')
+    parser.add_argument('--events', type=int, default=100,
+                        help='Number of simulated events (default 100)')
+    parser.add_argument('--delay', type=float, default=1.0,
+                        help='Seconds between two polls of an event')
+    parser.add_argument('--max-delay', type=float,
+                        help='Poll adaptively up to MAX_DELAY seconds apart')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='Seconds the test lasts (default 30)')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--probe-join', type=int, metavar='N')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Polls run at the same time (default 1)')
+    parser.add_argument('--parse-processes', type=int, metavar='N',
+                        help='Parse the pages in N processes')
+    parser.add_argument('--server', 
+                        help='URL of a running stand-in server. Default: '
+                             'start one')
+    standin.add_state_arguments(parser)
+    args = parser.parse_args()
+
+    process = None
+    url = args.server
+    if not url:
+        (process, url) = start_standin_process(capacity=args.capacity,
+                                               churn=args.churn,
+                                               latency=args.latency,
+                                               error_rate=args.error_rate,
+                                               session_ttl=args.session_ttl,
+                                               seed=args.seed)
+    try:
+        client = run(url, 
+                     args.events, 
+                     args.delay, 
+                     args.duration,
+                     args.max_delay,
+                     args.stream,
+                     args.probe_join,
+                     args.pool_size,
+                     args.workers,
+                     args.parse_processes)
+        server = requests.get(url + '/stats').json()
+    finally:
+        if process:
+            process.terminate()
+    print json.dumps({'client': client, 'server': server}, 
+                     indent=2, 
+                     sort_keys=True)
+
+if __name__ == '__main__':
+    main()
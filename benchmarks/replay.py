@@ -0,0 +1,92 @@
+"""
+Replay a recording of real traffic (coucheventjoiner.py --record FILE) and 
+measure the polling engine against it, without network.
+
+python -m benchmarks.replay traffic.json.gz --speed 10 --delay 1 --duration 60
+
+Every event page found in the recording is watched. Its answers come back as
+recorded: same pages changing at the same moments, same latencies and 
+errors, speed times faster. Results are printed as JSON.
+"""
+import json
+import argparse
+import coucheventjoiner
+from benchmarks import load
+
+def recorded_events(path):
+    """
+    Returns:
+    list: URLs of the event pages retrieved in the recording at path, in the
+        order they were first retrieved
+    """
+    events = []
+    for record in coucheventjoiner.read_recording(path):
+        if (record['method'] == 'GET' and 
+            record['url'] not in events and
+            coucheventjoiner.COUCHSURFING_EVENT_BASE_PATH in record['url']):
+            events.append(record['url'])
+    return events
+
+def replay_session(path, speed=1.0):
+    """
+    Returns:
+    requests.Session: answered by a ReplayAdapter of the recording at path
+    """
+    session = coucheventjoiner.make_session()
+    adapter = coucheventjoiner.ReplayAdapter(path, speed)
+    for prefix in ('https://', 'http://'):
+        session.mount(prefix, adapter)
+    return session
+
+def run(path, speed, delay, duration, max_delay=None, stream=False,
+        probe_every=None, workers=1):
+    """
+    Returns:
+    dict: measures of the client side (see load.measure)
+    """
+    manager = coucheventjoiner.SessionManager(replay_session(path, speed),
+                                              'replay',
+                                              'password')
+    result = load.measure(manager, 
+                          recorded_events(path), 
+                          delay, 
+                          duration, 
+                          max_delay, 
+                          stream, 
+                          probe_every, 
+                          workers)
+    result['speed'] = speed
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Poll the events of a recording without network')
+    parser.add_argument('recording', 
+                        help='File written by coucheventjoiner.py --record')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='How many times faster than recorded. 0: every '
+                             'answer in turn, without waiting (default 1)')
+    parser.add_argument('--delay', type=float, default=1.0,
+                        help='Seconds between two polls of an event')
+    parser.add_argument('--max-delay', type=float,
+                        help='Poll adaptively up to MAX_DELAY seconds apart')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='Seconds the replay lasts at most (default 30)')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--probe-join', type=int, metavar='N')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Polls run at the same time (default 1)')
+    args = parser.parse_args()
+    print json.dumps(run(args.recording,
+                         args.speed,
+                         args.delay,
+                         args.duration,
+                         args.max_delay,
+                         args.stream,
+                         args.probe_join,
+                         args.workers),
+                     indent=2,
+                     sort_keys=True)
+
+if __name__ == '__main__':
+    main()
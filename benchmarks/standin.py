@@ -0,0 +1,409 @@
+"""
+Local stand-in for couchsurfing, for load and soak tests.
+
+Serves /n/auth, /n/events/<id> and /n/events/<id>/join like couchsurfing does,
+as far as coucheventjoiner is concerned. Events are created on first access.
+Attendees leave and join them at random (churn), requests can be slowed down 
+(latency) or fail (error rate) and sessions expire.
+
+python -m benchmarks.standin --port 8000 --capacity 20 --churn 0.05
+
+Use standin_session to send the requests of coucheventjoiner to it.
+"""
+import re
+import json
+import time
+import copy
+import random
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+import urlparse
+from requests.adapters import HTTPAdapter
+import coucheventjoiner
+
+SESSION_COOKIE = '_couchsurfing_session'
+EVENT_PATH_RE = re.compile(r'^/n/events/([^/]+)(/join)?/?$')
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head><title>{name}</title></head>
+<body>
+<div id="main-menu">{menu}</div>
+<div class="primary_column">
+<div class="row-fluid" id="sidebar">
+{status}
+<div class="well-light event_sidebar_info"><ul>
+<li class="time"><span class="times">Starts {starts}</span></li>
+</ul></div>
+<div class="event_join_and_attendees" data-event="{name}">
+<a class="primary_action_button button join_event_button{join_hide}" href="#">Join</a>
+<a class="primary_action_button button leave_event_button{leave_hide}" href="#">Leave</a>
+</div>
+<div class="event_user_list_container event_attendee_list_container">
+<h3 class="event_user_list_title"><span class='attendee_count'>{attendees}</span><span> Attending{out_of}</span></h3>
+<ul class="event_user_list user_list">
+{attendee_list}
+</ul>
+</div>
+</div>
+</div>
+</body>
+</html>
+"""
+ATTENDEE_TEMPLATE = ('<li class="event_user_list_item user_item" '
+                     'data-id="{0}"><a class="user_image" '
+                     'href="/n/people/user{0}" title="User {0}">User {0}'
+                     '</a></li>')
+
+class Event(object):
+    """
+    Simulated event.
+    """
+    def __init__(self, name, capacity, attendees, starts, over=False):
+        self.name = name
+        self.capacity = capacity
+        self.attendees = attendees
+        self.starts = starts
+        self.over = over
+        #usernames of the users who joined through the stand-in
+        self.joined = set()
+        #when a spot last became free, None if the event is full
+        self.freed_at = None
+        self.last_churn = time.time()
+
+    def churn(self, rate, now, rng=random):
+        """
+        Make attendees leave and join, rate changes per second on average.
+
+        Changes are only applied when the event is accessed, each at a random
+        time since the previous access.
+        """
+        expected = rate * (now - self.last_churn)
+        changes = int(expected)
+        if rng.random() < expected - changes:
+            changes += 1
+        times = sorted(rng.uniform(self.last_churn, now) 
+                       for _ in xrange(changes))
+        self.last_churn = now
+        for when in times:
+            if rng.random() < 0.5 and self.attendees > len(self.joined):
+                self.attendees -= 1
+            elif self.capacity is None or self.attendees < self.capacity:
+                self.attendees += 1
+            self._update_freed(when)
+
+    def _update_freed(self, now):
+        if self.capacity is None or self.attendees >= self.capacity:
+            self.freed_at = None
+        elif self.freed_at is None:
+            self.freed_at = now
+
+    def join(self, username, now):
+        """
+        Returns:
+        bool: False if the event is full
+        """
+        if username in self.joined:
+            return True
+        if self.capacity is not None and self.attendees >= self.capacity:
+            return False
+        self.attendees += 1
+        self.joined.add(username)
+        self._update_freed(now)
+        return True
+
+    def render(self, username):
+        attending = username in self.joined
+        return PAGE_TEMPLATE.format(
+            name=self.name,
+            menu='<ul id="logged_in_menu"></ul>' if username else '',
+            status=('<div class="event_status"><p>This event is over.</p>'
+                    '</div>' if self.over else ''),
+            starts='{0} {1} {2}'.format(
+                self.starts.strftime('%I:%M'),
+                'am' if self.starts.hour < 12 else 'pm',
+                self.starts.strftime('%A, %B %d')),
+            join_hide=' hide' if attending else '',
+            leave_hide='' if attending else ' hide',
+            attendees=self.attendees,
+            out_of=(' out of {0}'.format(self.capacity) 
+                    if self.capacity is not None else ''),
+            attendee_list='\n'.join(ATTENDEE_TEMPLATE.format(i) 
+                                    for i in xrange(self.attendees)))
+
+class StandinState(object):
+    """
+    Events, sessions and statistics of the stand-in server.
+    """
+    def __init__(self, capacity=20, churn=0.0, latency=0.0, error_rate=0.0,
+                 session_ttl=None, full=True, seed=None):
+        """
+        Args:
+        capacity (int): spots of new events. None for no participant limit
+        churn (float): attendee changes per second and per event
+        latency (float): seconds added to every response
+        error_rate (float): fraction of requests answered with a 500
+        session_ttl (float): seconds before a session expires. None: never
+        full (bool): new events start full
+        """
+        self.capacity = capacity
+        self.churn = churn
+        self.latency = latency
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.full = full
+        self.random = random.Random(seed)
+        self.events = {}
+        #session id -> (username, created)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.requests = {'auth': 0, 'event': 0, 'join': 0, 'error': 0}
+        #seconds between a spot becoming free and the join request
+        self.times_to_join = []
+        self.joins = 0
+
+    def event(self, name):
+        if name not in self.events:
+            attendees = self.capacity if self.full and self.capacity else 0
+            starts = coucheventjoiner.datetime.datetime.now() + \
+                coucheventjoiner.datetime.timedelta(days=7)
+            self.events[name] = Event(name, self.capacity, attendees, starts)
+        return self.events[name]
+
+    def username(self, session_id):
+        """
+        Returns:
+        str: user of the session, None if the session doesn't exist or expired
+        """
+        if session_id not in self.sessions:
+            return None
+        (username, created) = self.sessions[session_id]
+        if self.session_ttl is not None and \
+                time.time() - created > self.session_ttl:
+            del self.sessions[session_id]
+            return None
+        return username
+
+    def login(self, username):
+        session_id = '{0:032x}'.format(self.random.getrandbits(128))
+        self.sessions[session_id] = (username, time.time())
+        return session_id
+
+    def stats(self):
+        times = sorted(self.times_to_join)
+        return {'requests': dict(self.requests),
+                'joins': self.joins,
+                'events': len(self.events),
+                'time_to_join': {
+                    'count': len(times),
+                    'median': times[len(times) // 2] if times else None,
+                    'p95': times[int(len(times) * 0.95)] if times else None,
+                    'max': times[-1] if times else None}}
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #send each response in one go (no Nagle/delayed ACK stalls)
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _session_id(self):
+        cookies = self.headers.getheader('Cookie') or ''
+        match = re.search(SESSION_COOKIE + r'=([0-9a-f]+)', cookies)
+        return match.group(1) if match else None
+
+    def _respond(self, status, body='', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _prologue(self):
+        """
+        Returns:
+        bool: False if the request must fail with an error
+        """
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        with self.state.lock:
+            failed = self.state.random.random() < self.state.error_rate
+            if failed:
+                self.state.requests['error'] += 1
+        if failed:
+            self._respond(500, 'Simulated error')
+        return not failed
+
+    def _read_body(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        return urlparse.parse_qs(self.rfile.read(length))
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path
+        if path == '/stats':
+            with self.state.lock:
+                stats = self.state.stats()
+            return self._respond(200, json.dumps(stats), 
+                                 {'Content-Type': 'application/json'})
+        match = EVENT_PATH_RE.match(path)
+        if not match or match.group(2):
+            return self._respond(404, 'Not found')
+        if not self._prologue():
+            return
+        with self.state.lock:
+            self.state.requests['event'] += 1
+            event = self.state.event(match.group(1))
+            event.churn(self.state.churn, time.time(), self.state.random)
+            page = event.render(self.state.username(self._session_id()))
+        self._respond(200, page, {'Content-Type': 'text/html; charset=utf-8'})
+
+    def do_POST(self):
+        path = urlparse.urlsplit(self.path).path
+        if path.rstrip('/') == coucheventjoiner.COUCHSURFING_AUTH_BASE_PATH:
+            return self._auth()
+        match = EVENT_PATH_RE.match(path)
+        if not match or not match.group(2):
+            return self._respond(404, 'Not found')
+        self._read_body()
+        if not self._prologue():
+            return
+        now = time.time()
+        with self.state.lock:
+            self.state.requests['join'] += 1
+            username = self.state.username(self._session_id())
+            event = self.state.event(match.group(1))
+            event.churn(self.state.churn, now, self.state.random)
+            freed_at = event.freed_at
+            joined = username is not None and event.join(username, now)
+            if joined and freed_at is not None:
+                self.state.joins += 1
+                self.state.times_to_join.append(now - freed_at)
+        if username is None:
+            return self._respond(401, '{"error":"Not logged in."}')
+        if not joined:
+            return self._respond(200, '{"error":"This event is full."}')
+        self._respond(200, '{}')
+
+    def _auth(self):
+        form = self._read_body()
+        if not self._prologue():
+            return
+        username = form.get('username', [''])[0]
+        with self.state.lock:
+            self.state.requests['auth'] += 1
+            if not username or not form.get('password', [''])[0]:
+                session_id = None
+            else:
+                session_id = self.state.login(username)
+        if session_id is None:
+            return self._respond(406, '{"errors":"Invalid username/password"}')
+        self._respond(200, '', {'Set-Cookie': '{0}={1}; Path=/'.format(
+                    SESSION_COOKIE, session_id)})
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, state):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandinHandler)
+        self.state = state
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+def start_server(state, host='127.0.0.1', port=0):
+    """
+    Serve state from a background thread.
+
+    Returns:
+    StandinServer: call shutdown() to stop it
+    """
+    server = StandinServer((host, port), state)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+class StandinAdapter(HTTPAdapter):
+    """
+    Send the requests for couchsurfing to the stand-in server instead.
+
+    The responses keep the couchsurfing URL so that cookies are stored for
+    couchsurfing as usual.
+    """
+    def __init__(self, standin_url, **kwargs):
+        super(StandinAdapter, self).__init__(**kwargs)
+        self.standin_url = standin_url.rstrip('/')
+
+    def send(self, request, **kwargs):
+        (_, _, path, query, fragment) = urlparse.urlsplit(request.url)
+        redirected = copy.copy(request)
+        redirected.headers = request.headers.copy()
+        redirected.url = urlparse.urlunsplit(
+            urlparse.urlsplit(self.standin_url)[:2] + (path, query, fragment))
+        response = super(StandinAdapter, self).send(redirected, **kwargs)
+        response.url = request.url
+        response.request = request
+        return response
+
+def standin_session(standin_url, session=None, pool_maxsize=10):
+    """
+    Returns:
+    requests.Session: sending the couchsurfing requests to standin_url
+    """
+    session = session or coucheventjoiner.make_session()
+    session.mount('https://' + coucheventjoiner.COUCHSURFING_NETLOC,
+                  StandinAdapter(standin_url, pool_maxsize=pool_maxsize))
+    return session
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for couchsurfing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_state_arguments(parser)
+    return parser.parse_args()
+
+def add_state_arguments(parser):
+    parser.add_argument('--capacity', type=int, default=20,
+                        help='Spots per event (default 20)')
+    parser.add_argument('--churn', type=float, default=0.0,
+                        help='Attendee changes per second and per event')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests failing with a 500')
+    parser.add_argument('--session-ttl', type=float,
+                        help='Seconds before a session expires')
+    parser.add_argument('--seed', type=int, help='Random seed')
+
+def state_from_args(args):
+    return StandinState(capacity=args.capacity,
+                        churn=args.churn,
+                        latency=args.latency,
+                        error_rate=args.error_rate,
+                        session_ttl=args.session_ttl,
+                        seed=args.seed)
+
+def main():
+    args = parse_args()
+    server = StandinServer((args.host, args.port), state_from_args(args))
+    print "Serving on {0}".format(server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,48 @@ __version__ = '0.1'
 from enum import Enum
 import sys
 import os
+import stat
 import re
 import time
+import heapq
+import bisect
+import json
+import contextlib
+import errno
+import itertools
+import threading
+import Queue
+import weakref
+import random
+import datetime
+import hashlib
+import binascii
 import argparse
 import urlparse
-import getpass
-import requests
-from requests.exceptions import RequestException
-import lxml.html
+import collections
+#requests, lxml and the other slow imports are done by the functions using 
+#them: --help and wrong arguments are answered without loading them
 
 
 COUCHSURFING_NETLOC = 'www.couchsurfing.org'
 COUCHSURFING_EVENT_BASE_PATH = '/n/events/'
 COUCHSURFING_AUTH_BASE_PATH = '/n/auth'
+DEFAULT_METRICS_INTERVAL = 60
 DEFAULT_RETRY_DELAY = 30
 MIN_RETRY_DELAY = 10
+STREAM_CHUNK_SIZE = 8192
+SESSION_DIR = os.path.join(os.path.expanduser('~'), 
+                           '.coucheventjoiner', 
+                           'sessions')
+CONTROL_SOCKET = os.path.join(os.path.expanduser('~'), 
+                              '.coucheventjoiner', 
+                              'control.sock')
+CONTROL_TIMEOUT = 5
+DEFAULT_SHARED_TTL = 10
+DEFAULT_POOL_SIZE = 10
+FEED_FLUSH_INTERVAL = 1
+#seconds a page waits for a parsing process before it is polled again
+PARSE_TIMEOUT = 30
 
 def write_error_and_exit(message):
     sys.stderr.write("{0}: error: {1}\n".format(
@@ -25,17 +52,19 @@ def write_error_and_exit(message):
                      )
     sys.exit(2)    
 
-def validate_event_url(url):
+def normalize_event_url(url):
     """
-    sys.exit if wrong.
     Return a cleaned up version of the url 
+
+    Raises:
+    ValueError: if url isn't the URL of an event
     """
 
     (_, netloc, path, _, _) = urlparse.urlsplit(url)
     #regexp incorrect (but good enough). Accepts characters incorrect in a URL
     if(netloc != COUCHSURFING_NETLOC or 
        not re.match(COUCHSURFING_EVENT_BASE_PATH + "[^/]+$", path)):
-        write_error_and_exit(
+        raise ValueError(
             "URL invalid. Expecting {0}, got {1}".format(
                 COUCHSURFING_NETLOC + COUCHSURFING_EVENT_BASE_PATH + "...", 
                 netloc + path)
@@ -47,6 +76,43 @@ def validate_event_url(url):
                                '') #fragment
                                ) 
 
+def validate_event_url(url):
+    """
+    sys.exit if wrong.
+    Return a cleaned up version of the url 
+    """
+    try:
+        return normalize_event_url(url)
+    except ValueError, e:
+        write_error_and_exit(e.message)
+
+def read_event_urls(lines, seen=None):
+    """
+    Valid event URLs of lines, normalized by normalize_event_url, each one
+    once.
+
+    Blank lines and lines starting with # are skipped. Invalid URLs are 
+    reported on stderr and skipped.
+
+    Args:
+    lines (iterable of str): one URL per line. Only read as the URLs are 
+        consumed
+    seen (set): URLs to skip. The URLs yielded are added to it
+    """
+    seen = set() if seen is None else seen
+    for (number, line) in enumerate(lines, 1):
+        url = line.strip()
+        if not url or url.startswith('#'):
+            continue
+        try:
+            url = normalize_event_url(url)
+        except ValueError, e:
+            sys.stderr.write("line {0}: {1}\n".format(number, e.message))
+            continue
+        if url not in seen:
+            seen.add(url)
+            yield url
+
 def parse_args():
     """sys.exit if wrong arguments"""
     parser = argparse.ArgumentParser(
@@ -57,6 +123,110 @@ def parse_args():
                         default=DEFAULT_RETRY_DELAY,
                         help='Delay before retrying if event is full'
                              '(in seconds)')
+    parser.add_argument('-m',
+                        '--max-delay',
+                        type=int,
+                        help='Poll adaptively: often when attendees come and '
+                             'go or when the event is about to start, up to '
+                             'MAX_DELAY seconds apart when nothing changes')
+    parser.add_argument('-b',
+                        '--budget',
+                        type=int,
+                        help='Maximum number of polls per minute for all the '
+                             'events together. Needs --max-delay')
+    parser.add_argument('-r',
+                        '--max-rate',
+                        type=float,
+                        help='Never send more than MAX_RATE requests per '
+                             'second to couchsurfing')
+    parser.add_argument('-p',
+                        '--probe-join',
+                        type=int,
+                        metavar='N',
+                        help='Only retrieve the event page every N polls. In '
+                             'between, try to join right away: the answer '
+                             'tells if the event is still full')
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='Poll up to N events at the same time, each one '
+                             'over its own kept-alive connection')
+    parser.add_argument('--parse-processes',
+                        type=int,
+                        metavar='N',
+                        help='Parse the event pages in N processes, out of '
+                             'the threads of --workers doing the network '
+                             'I/O. Not used with --stream')
+    parser.add_argument('--no-session-store',
+                        dest='session_store',
+                        action='store_false',
+                        help="Don't reuse the session of the previous run and "
+                             "don't save it in " + SESSION_DIR)
+    parser.add_argument('--daemon',
+                        nargs='?',
+                        const=CONTROL_SOCKET,
+                        metavar='SOCKET',
+                        help='Keep running and accept commands to add and '
+                             'remove events on the Unix socket SOCKET '
+                             '(default: ' + CONTROL_SOCKET + ')')
+    parser.add_argument('--state-db',
+                        help='SQLite database where the state of the watched '
+                             'events is kept. After a restart, polling '
+                             'resumes where it stopped')
+    parser.add_argument('--shared-cache',
+                        metavar='PATH',
+                        help='SQLite file through which the instances of '
+                             'the program running on this host share the '
+                             'event pages they retrieve')
+    parser.add_argument('--shared-ttl',
+                        type=int,
+                        default=DEFAULT_SHARED_TTL,
+                        help='Seconds during which an event page retrieved '
+                             'by another instance is used instead of '
+                             'retrieving it again')
+    parser.add_argument('--feed',
+                        metavar='FILE',
+                        help='Append a JSON line to FILE each time an event '
+                             'changes: attendees, capacity, over, logged '
+                             'in or out, joined. - writes the lines to '
+                             'stdout and the messages to stderr')
+    parser.add_argument('--record',
+                        metavar='FILE',
+                        help='Write the requests sent to couchsurfing and '
+                             'the answers to FILE (gzip), to be replayed '
+                             'by benchmarks.replay')
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        help='Serve metrics on http://127.0.0.1:PORT/metrics '
+                             '(Prometheus) and /metrics.json')
+    parser.add_argument('--metrics-file',
+                        help='Write the metrics as JSON in METRICS_FILE '
+                             'periodically and when the program stops')
+    parser.add_argument('--metrics-interval',
+                        type=int,
+                        default=DEFAULT_METRICS_INTERVAL,
+                        help='Seconds between two writes of --metrics-file')
+    parser.add_argument('-e',
+                        '--event',
+                        dest='other_events',
+                        action='append',
+                        default=[],
+                        metavar='EVENT',
+                        help='Another event URL to watch. Can be repeated')
+    parser.add_argument('-f',
+                        '--events-file',
+                        type=argparse.FileType('r'),
+                        metavar='FILE',
+                        help='Also watch the event URLs of FILE, one per '
+                             'line. - reads them from stdin. Invalid URLs '
+                             'are reported and skipped')
+    parser.add_argument('-s',
+                        '--stream',
+                        action='store_true',
+                        help='Stop downloading event pages as soon as the '
+                             'number of attendees is known')
     parser.add_argument('event', 
                         type=str, 
                         help='Event URL')
@@ -76,9 +246,29 @@ def get_user_values():
     args = parse_args()
     if(args['delay'] < MIN_RETRY_DELAY):
         write_error_and_exit(" Minimum allowed delay is {0}".format(MIN_RETRY_DELAY))
+    if(args['max_delay'] is not None and args['max_delay'] < args['delay']):
+        write_error_and_exit("Maximum delay can't be smaller than delay")
+    if(args['budget'] is not None and 
+       (args['budget'] <= 0 or args['max_delay'] is None)):
+        write_error_and_exit("Budget must be positive and needs --max-delay")
+    if(args['max_rate'] is not None and args['max_rate'] <= 0):
+        write_error_and_exit("Maximum rate must be positive")
+    if(args['probe_join'] is not None and args['probe_join'] < 2):
+        write_error_and_exit("--probe-join must be at least 2")
+    if(args['workers'] < 1):
+        write_error_and_exit("Number of workers must be positive")
+    if(args['parse_processes'] is not None and args['parse_processes'] < 1):
+        write_error_and_exit("Number of parsing processes must be positive")
+    if(args['shared_ttl'] <= 0):
+        write_error_and_exit("Shared cache TTL must be positive")
+    if(args['metrics_interval'] <= 0):
+        write_error_and_exit("Metrics interval must be positive")
     args['event'] = validate_event_url(args['event'])
+    args['other_events'] = [validate_event_url(event) 
+                            for event in args['other_events']]
     #None instead of 'not x' because allow empty passwords
     if args['password'] is None: 
+        import getpass
         args['password'] = getpass.getpass()
     
     return args
@@ -95,6 +285,471 @@ class ParsingError(Exception):
     """
     pass
 
+class Metrics(object):
+    """
+    Counters and timing histograms of what the program does.
+
+    Every value has labels (event, result...). The values can be exported in
+    the Prometheus text format or as JSON.
+    """
+    #upper bounds of the histogram buckets, in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 
+               2.5, 5, 10)
+    PREFIX = 'coucheventjoiner_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #(name, labels) -> value
+        self._counters = {}
+        #(name, labels) -> [count per bucket..., count, sum]
+        self._histograms = {}
+        #labels and (label, value) pairs shared by the keys of the values
+        self._interned = {}
+
+    def _intern(self, key):
+        """
+        key made of the labels and pairs of labels already used by other
+        values. With thousands of events, the same ('event', url) pair is 
+        in about ten keys per event.
+        """
+        (name, labels) = key
+        labels = tuple(self._interned.setdefault(pair, pair) 
+                       for pair in labels)
+        return (name, self._interned.setdefault(labels, labels))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._counters:
+                self._counters[key] += value
+            else:
+                self._counters[self._intern(key)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [0] * (len(self.BUCKETS) + 2)
+                self._histograms[self._intern(key)] = histogram
+            i = bisect.bisect_left(self.BUCKETS, seconds)
+            if i < len(self.BUCKETS):
+                histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the with block takes"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._interned.clear()
+
+    def to_dict(self):
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for ((name, labels), value) 
+                        in sorted(self._counters.items())]
+            histograms = []
+            for ((name, labels), histogram) in sorted(self._histograms.items()):
+                buckets = []
+                cumulative = 0
+                for (bound, count) in zip(self.BUCKETS, histogram):
+                    cumulative += count
+                    buckets.append([bound, cumulative])
+                histograms.append({'name': name, 
+                                   'labels': dict(labels), 
+                                   'buckets': buckets,
+                                   'count': histogram[-2], 
+                                   'sum': histogram[-1]})
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join(
+                '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                                   .replace('"', '\\"').replace('\n', '\\n'))
+                for (name, value) in labels) + '}'
+
+        lines = []
+        metrics = self.to_dict()
+        declared = set()
+        for counter in metrics['counters']:
+            name = self.PREFIX + counter['name']
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE {0} counter'.format(name))
+            lines.append('{0}{1} {2}'.format(
+                    name, 
+                    format_labels(sorted(counter['labels'].items())),
+                    counter['value']))
+        for histogram in metrics['histograms']:
+            name = self.PREFIX + histogram['name']
+            labels = sorted(histogram['labels'].items())
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE {0} histogram'.format(name))
+            for (bound, count) in histogram['buckets']:
+                lines.append('{0}_bucket{1} {2}'.format(
+                        name, format_labels(labels, [('le', bound)]), count))
+            lines.append('{0}_bucket{1} {2}'.format(
+                    name, 
+                    format_labels(labels, [('le', '+Inf')]), 
+                    histogram['count']))
+            lines.append('{0}_sum{1} {2}'.format(
+                    name, format_labels(labels), histogram['sum']))
+            lines.append('{0}_count{1} {2}'.format(
+                    name, format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """Write the metrics as JSON in path"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.rename(tmp_path, path)
+
+#metrics of the whole program
+metrics = Metrics()
+
+def serve_metrics(port, host='127.0.0.1'):
+    """
+    Serve the metrics on http://host:port/metrics (Prometheus) and 
+    /metrics.json from a background thread.
+
+    Returns:
+    BaseHTTPServer.HTTPServer
+    """
+    import BaseHTTPServer
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                (body, content_type) = (metrics.to_prometheus(), 
+                                        'text/plain; version=0.0.4')
+            elif self.path == '/metrics.json':
+                (body, content_type) = (json.dumps(metrics.to_dict()),
+                                        'application/json')
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def dump_metrics_periodically(path, interval):
+    """
+    Write the metrics as JSON in path every interval seconds, from a 
+    background thread.
+    """
+    def dump():
+        while True:
+            time.sleep(interval)
+            metrics.dump(path)
+    thread = threading.Thread(target=dump)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+class TokenBucket(object):
+    """
+    Limit the rate of requests.
+
+    Up to burst requests can be made at once, after that at most rate 
+    requests per second. acquire blocks until a request can be made.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, 
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            #sleeping with the lock held keeps the requests in order
+            if wait:
+                time.sleep(wait)
+
+def throttle(session, bucket):
+    """
+    Make every request of session (page retrieval, join, login, 
+    redirects...) take a token from bucket first.
+
+    Returns:
+    requests.Session: session
+    """
+    send = session.send
+    def throttled_send(request, **kwargs):
+        bucket.acquire()
+        return send(request, **kwargs)
+    #requests sends redirects through session.send too
+    session.send = throttled_send
+    session.bucket = bucket
+    return session
+
+def make_session(max_rate=None, pool_size=DEFAULT_POOL_SIZE):
+    """
+    Args:
+    pool_size (int): connections kept alive per host. Should be at least the
+        number of polls done at the same time: with pool_block, a poll waits
+        for a free connection instead of opening one that is thrown away
+
+    Returns:
+    requests.Session: throttled to max_rate requests per second if given
+    """
+    import requests
+    import requests.adapters
+    session = requests.Session()
+    for prefix in ('https://', 'http://'):
+        #retries are left to the polling loop, which knows the delays
+        session.mount(prefix, requests.adapters.HTTPAdapter(
+                pool_maxsize=pool_size, 
+                pool_block=True, 
+                max_retries=0))
+    if max_rate:
+        throttle(session, TokenBucket(max_rate))
+    return session
+
+class FakeAdapter(object):
+    """
+    In-memory stand-in for the network, mounted on a session in place of 
+    its HTTP adapters. Answers the requests of the session without opening
+    any connection and records them.
+
+    Args:
+    routes (list): of (method, URL regular expression, answer). answer is a 
+        dict with the optional keys status_code (default 200), content, 
+        headers and error (message of a ConnectionError raised instead of 
+        answering), or a function taking the PreparedRequest and returning 
+        such a dict. The first matching route answers, a request without 
+        route gets a 404
+    """
+    def __init__(self, routes=()):
+        self.routes = list(routes)
+        #PreparedRequests sent, in order
+        self.sent = []
+
+    def route(self, method, url, answer):
+        self.routes.append((method, url, answer))
+
+    def _answer(self, request):
+        self.sent.append(request)
+        for (method, url, answer) in self.routes:
+            if method == request.method and re.match(url, request.url):
+                return answer(request) if callable(answer) else answer
+        return {'status_code': 404}
+
+    def send(self, request, stream=False, **kwargs):
+        import io
+        import requests
+        answer = self._answer(request)
+        if 'error' in answer:
+            raise requests.exceptions.ConnectionError(answer['error'], 
+                                                      request=request)
+        response = requests.Response()
+        response.status_code = answer.get('status_code', 200)
+        response.reason = answer.get('reason')
+        response.headers.update(answer.get('headers', {}))
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        #read by Session.send unless stream, like a real body
+        response.raw = io.BytesIO(answer.get('content', ''))
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+def fake_session(routes=()):
+    """
+    Returns:
+    (requests.Session, FakeAdapter): session answered by the FakeAdapter
+    """
+    session = make_session()
+    adapter = FakeAdapter(routes)
+    for prefix in ('https://', 'http://'):
+        session.mount(prefix, adapter)
+    return (session, adapter)
+
+class Recorder(object):
+    """
+    gzip file of JSON lines where RecordingAdapters write the requests of a 
+    session and their answers, one line per request, for ReplayAdapter.
+
+    A line has the time of the request since the start of the recording, its
+    method and URL, then the latency, status_code, reason, headers and 
+    content of the answer, or the error raised instead. Request bodies (the
+    password), cookies and Set-Cookie headers are not recorded.
+    """
+    #describe the recorded body, not the one replayed
+    SKIPPED_HEADERS = ('set-cookie', 'content-encoding', 'content-length',
+                       'transfer-encoding')
+
+    def __init__(self, path):
+        import gzip
+        self._file = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+        self.start = time.time()
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            #readable up to here even if the program is killed
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class RecordingAdapter(object):
+    """Passes the requests to adapter and writes them to a Recorder"""
+    def __init__(self, adapter, recorder):
+        self.adapter = adapter
+        self.recorder = recorder
+
+    def send(self, request, stream=False, **kwargs):
+        from requests.exceptions import RequestException
+        start = time.time()
+        record = {'time': start - self.recorder.start,
+                  'method': request.method,
+                  'url': request.url}
+        try:
+            response = self.adapter.send(request, stream=stream, **kwargs)
+            #read now to be recorded: a streamed caller gets it from memory
+            content = response.content
+        except RequestException, e:
+            record.update(latency=time.time() - start, error=str(e))
+            self.recorder.write(record)
+            raise
+        record.update(latency=time.time() - start,
+                      status_code=response.status_code,
+                      reason=response.reason,
+                      headers=dict((name, value) for (name, value) 
+                                   in response.headers.items() 
+                                   if name.lower() 
+                                   not in Recorder.SKIPPED_HEADERS),
+                      #any byte string survives JSON this way
+                      content=content.decode('latin-1'))
+        self.recorder.write(record)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+def record_session(session, path):
+    """
+    Record the requests of session and their answers in path. See Recorder
+
+    Returns:
+    Recorder: to close once the session isn't used any more
+    """
+    recorder = Recorder(path)
+    for (prefix, adapter) in session.adapters.items():
+        session.mount(prefix, RecordingAdapter(adapter, recorder))
+    return recorder
+
+def read_recording(path):
+    """
+    Yields:
+    dict: the records of a Recorder file, in order. A file cut short by a 
+        killed program is read up to the last complete record
+    """
+    import zlib
+    #gzip.GzipFile drops what it decompressed last when the end is missing
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    rest = ''
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            try:
+                lines = (rest + decompressor.decompress(chunk)).split('\n')
+            except zlib.error:
+                return
+            rest = lines.pop()
+            for line in lines:
+                yield json.loads(line)
+
+class ReplayAdapter(FakeAdapter):
+    """
+    Answers the requests of a session with the answers of a recording (see 
+    Recorder), without network.
+
+    The replay clock starts with the first request and runs speed times
+    faster than the recording. A request gets the last answer recorded for 
+    its method and URL before that time on the clock, the first one if there
+    is none yet, after its recorded latency divided by speed. Pages change
+    then as they did when recorded, whatever the polling frequency.
+
+    With a speed of 0 the answers of a method and URL are given in their 
+    recorded order as fast as possible, the last one repeated when they run 
+    out. Requests never recorded get a 404.
+    """
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        #(method, url) -> ([time], [record]) in recorded order
+        self._records = {}
+        for record in read_recording(path):
+            if 'content' in record:
+                record['content'] = record['content'].encode('latin-1')
+            (times, records) = self._records.setdefault(
+                (record['method'], record['url']), ([], []))
+            times.append(record['time'])
+            records.append(record)
+        self._lock = threading.Lock()
+        self._start = None
+        #(method, url) -> index of the next answer when speed is 0
+        self._next = {}
+
+    def _answer(self, request):
+        key = (request.method, request.url)
+        if key not in self._records:
+            return {'status_code': 404}
+        (times, records) = self._records[key]
+        with self._lock:
+            if self._start is None:
+                self._start = time.time()
+            if self.speed:
+                clock = (time.time() - self._start) * self.speed
+                i = max(bisect.bisect_right(times, clock) - 1, 0)
+            else:
+                i = min(self._next.get(key, 0), len(records) - 1)
+                self._next[key] = i + 1
+        record = records[i]
+        if self.speed:
+            time.sleep(record['latency'] / self.speed)
+        return record
+
 def login(username, password, session=None):
     """
     Attempts to login to Couchsurfing.
@@ -107,73 +762,126 @@ def login(username, password, session=None):
     LoginException: login failed
     """
     if not session:
-        session = requests.Session()
+        session = make_session()
     #authenticity_token missing but it still works
-    r = session.post('https://' + 
+    with metrics.timer('login_seconds'):
+        r = session.post('https://' + 
                      COUCHSURFING_NETLOC + 
                      COUCHSURFING_AUTH_BASE_PATH, 
-                     data={'return_to':'', 
-                           'username':username, 
-                           'password':password}
-                     )
+                         data={'return_to':'', 
+                               'username':username, 
+                               'password':password}
+                         )
+    metrics.inc('logins_total', status=r.status_code)
     if r.status_code == 200:
         return session
     else:
         raise LoginException("Login failed. HTTP code : {0} {1}".format( 
                 r.status_code, r.reason))
 
-def is_logged_in(tree):
+class _LazyXPath(object):
     """
-    Determine if logged in.
-    
-    Args:
-    tree (lxml.html.HtmlElement) : content of a couchsurfing page
+    Stands for an lxml.etree.XPath until a page is parsed. Then lxml is 
+    imported and all the expressions are compiled, each one taking the place
+    of its _LazyXPath in the module.
     """
-    return bool(tree.xpath('//*[@id="main-menu"]/*[@id="logged_in_menu"]'))
+    def __init__(self, path):
+        self.path = path
+        self.compiled = None
 
-def is_event_over(tree):
-    """
-    Determine if the event is over
+    def __call__(self, node):
+        if self.compiled is None:
+            _compile_xpaths()
+        return self.compiled(node)
 
-    Args:
-    tree (lxml.html.HtmlElement) : content of a couchsurfing page representing 
-        an event
+def _compile_xpaths():
+    import lxml.etree
+    module = globals()
+    for (name, value) in module.items():
+        if isinstance(value, _LazyXPath):
+            value.compiled = lxml.etree.XPath(value.path)
+            module[name] = value.compiled
+
+#XPath expressions are compiled once. Everything but the menu lives in the
+#sidebar which is looked up through its id instead of walking the whole page.
+_logged_in_xpath = _LazyXPath('id("main-menu")/*[@id="logged_in_menu"]')
+_sidebar_xpath = _LazyXPath('id("sidebar")')
+#Technically wrong. The searched class could be a substring of another one
+#class="foobar"-> searching for 'bar' would match even tough it's not in it
+_event_over_xpath = _LazyXPath(
+    'div[contains(@class, "event_status")]'
+    '/*[text()="This event is over."]')
+_leave_button_xpath = _LazyXPath(
+    'div[contains(@class, "event_join_and_attendees")]'
+    '//a[contains(@class, "leave_event_button") '
+    'and not(contains(@class, "hide"))]')
+_attendee_title_xpath = _LazyXPath(
+    'div[contains(@class, "event_attendee_list_container")]'
+    '/*[contains(@class, "event_user_list_title")]')
+_span_text_xpath = _LazyXPath('span/text()')
+_start_xpath = _LazyXPath(
+    'div[contains(@class, "event_sidebar_info")]'
+    '//li[contains(@class, "time")]/span[contains(@class, "times")]/text()')
+_start_re = re.compile(r'Starts\s+(\d{1,2}:\d{2}\s*[ap]m)\s+\w+,\s+(\w+\s+\d{1,2})')
+
+def _sidebar(tree):
+    sidebar = _sidebar_xpath(tree)
+    return sidebar[0] if sidebar else None
+
+def _is_event_over(sidebar):
+    return sidebar is not None and bool(_event_over_xpath(sidebar))
+
+def _is_attending(sidebar):
+    return sidebar is not None and bool(_leave_button_xpath(sidebar))
+
+def _event_start(sidebar, now=None):
     """
-    #Technically wrong. The searched class could be a substring of another one
-    #class="foobar"-> searching for 'bar' would match even tough it's not in it
-    return bool(tree.xpath('//*[@id="sidebar"]'
-                          '/div[contains(@class, "event_status")]'
-                          '/*[text()="This event is over."]')
-                )
+    Read when the event starts.
 
-def is_attending(tree):
-    return bool(tree.xpath('//div[contains(@class, "event_join_and_attendees")]'
-                           '//a[contains(@class, "leave_event_button") '
-                           'and not(contains(@class, "hide"))]')
-                )
+    The page doesn't show the year, the one putting the start closest to now
+    is used.
 
-def is_event_full(tree):
+    Returns:
+    datetime.datetime: None if the start couldn't be read
     """
-    Determine if event is full
+    texts = _start_xpath(sidebar) if sidebar is not None else []
+    match = _start_re.search(texts[0]) if texts else None
+    if not match:
+        return None
+    try:
+        start = datetime.datetime.strptime(' '.join(match.groups()),
+                                           '%I:%M %p %B %d')
+    except ValueError:
+        return None
+    now = now or datetime.datetime.now()
+    candidates = []
+    for year in (now.year - 1, now.year, now.year + 1):
+        try:
+            candidates.append(start.replace(year=year))
+        except ValueError:
+            #February 29
+            pass
+    return min(candidates, key=lambda c: abs(c - now)) if candidates else None
 
-    Args:
-    tree (lxml.html.HtmlElement) : content of a couchurfing page 
-        representing an event
+def _attendee_counter(sidebar):
+    """
+    Read the attendee counter of an event.
+
+    Returns:
+    (int, int): number of attendees and number of spots. The number of spots
+        is None if the event has no participant limit.
 
     Raises:
-    ParsingError: Couldn't retrieve data from page to determine if event is full
+    ParsingError: Couldn't retrieve the counter from the page
     """
-    attendee_count_results = tree.xpath(
-            '//div[contains(@class, "event_attendee_list_container")]'
-            '/*[contains(@class, "event_user_list_title")]'
-            '/span[1]/text()'
-            )
-    if not attendee_count_results:
+    title = _attendee_title_xpath(sidebar) if sidebar is not None else []
+    spans = _span_text_xpath(title[0]) if title else []
+    if not spans:
         raise ParsingError("Can\t determine if event full. "
             "(Couldn't retrieve number of attendees)"
                            )
     try:
-        attendee_count = int(attendee_count_results[0])
+        attendee_count = int(spans[0])
     except ValueError:
         raise ParsingError("Can't determine if event full. "
             "(Couldn't Parse number of attendees)"
@@ -181,59 +889,613 @@ def is_event_full(tree):
 
     #if an event has a participant limit it will contain " Attending out of xx"
     #if an event has no participant limit it will contain " Attending"
-    attending = tree.xpath(
-            '//div[contains(@class, "event_attendee_list_container")]'
-            '/*[contains(@class, "event_user_list_title")]'
-            '/span[2]/text()'
-            )
-    if not attending:
+    if len(spans) < 2:
         raise ParsingError('Can\'t determine if event full. '
                            'Couldn\'t retrieve number of spots available'
                            )
-    if not 'out of' in attending[0]:
+    if not 'out of' in spans[1]:
         #no participant limit
-        return False
+        return (attendee_count, None)
     
     try:
-        total_spots = int(attending[0].split()[-1])
-    except ValueError, IndexError:
+        total_spots = int(spans[1].split()[-1])
+    except (ValueError, IndexError):
         raise ParsingError('Can\'t determine if event full. '
                            'Couldn\'t parse number of spots available'
                            )
+    return (attendee_count, total_spots)
+
+def session_file(username, directory=None):
+    """
+    Path of the file storing the cookies of username
+    """
+    import urllib
+    return os.path.join(directory or SESSION_DIR, 
+                        urllib.quote(username, safe='') + '.lwp')
+
+def save_cookies(session, username, directory=None):
+    """
+    Store the cookies of session so that the next run can reuse them.
+
+    The file is only readable by the current user.
+    """
+    import cookielib
+    path = session_file(username, directory)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), 0700)
+    jar = cookielib.LWPCookieJar()
+    for cookie in session.cookies:
+        jar.set_cookie(cookie)
+    #write to a new file (created 0600) and replace the old one
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, 'w') as f:
+        f.write("#LWP-Cookies-2.0\n")
+        #login cookies are session cookies, keep them anyway
+        f.write(jar.as_lwp_str(ignore_discard=True))
+    os.rename(tmp_path, path)
+
+def load_cookies(session, username, directory=None):
+    """
+    Put the cookies saved by save_cookies for username in session.
+
+    Returns:
+    bool: True if cookies were loaded
+    """
+    import cookielib
+    jar = cookielib.LWPCookieJar()
+    try:
+        jar.load(session_file(username, directory), ignore_discard=True)
+    except (IOError, cookielib.LoadError):
+        return False
+    for cookie in jar:
+        session.cookies.set_cookie(cookie)
+    return len(jar) > 0
+
+def is_logged_in(tree):
+    """
+    Determine if logged in.
+    
+    Args:
+    tree (lxml.html.HtmlElement) : content of a couchsurfing page
+    """
+    return bool(_logged_in_xpath(tree))
+
+def is_event_over(tree):
+    """
+    Determine if the event is over
+
+    Args:
+    tree (lxml.html.HtmlElement) : content of a couchsurfing page representing 
+        an event
+    """
+    return _is_event_over(_sidebar(tree))
+
+def is_attending(tree):
+    return _is_attending(_sidebar(tree))
+
+def is_event_full(tree):
+    """
+    Determine if event is full
+
+    Args:
+    tree (lxml.html.HtmlElement) : content of a couchurfing page 
+        representing an event
+
+    Raises:
+    ParsingError: Couldn't retrieve data from page to determine if event is full
+    """
+    (attendee_count, total_spots) = _attendee_counter(_sidebar(tree))
+    return total_spots is not None and attendee_count >= total_spots
+
+class EventPageState(collections.namedtuple('EventPageState',
+                                            ['logged_in',
+                                             'over',
+                                             'attending',
+                                             'attendee_count',
+                                             'capacity',
+                                             'starts'])):
+    """
+    What the polling loop needs to know about an event page.
+
+    attendee_count is None if the attendee counter couldn't be read. 
+    capacity is None if the event has no participant limit.
+    starts is None if the start of the event couldn't be read.
+    """
+    __slots__ = ()
+
+    def is_full(self):
+        """
+        Raises:
+        ParsingError: the attendee counter couldn't be read from the page
+        """
+        if self.attendee_count is None:
+            raise ParsingError("Can't determine if event full. "
+                               "(Couldn't retrieve number of attendees)")
+        return self.capacity is not None and \
+            self.attendee_count >= self.capacity
+
+def extract_event_state(tree):
+    """
+    Read everything the checks need from an event page in one go.
 
-    return attendee_count == total_spots
+    Args:
+    tree (lxml.html.HtmlElement) : content of a couchsurfing page 
+        representing an event
+
+    Returns:
+    EventPageState
+    """
+    sidebar = _sidebar(tree)
+    try:
+        (attendee_count, capacity) = _attendee_counter(sidebar)
+    except ParsingError:
+        (attendee_count, capacity) = (None, None)
+    return EventPageState(logged_in=is_logged_in(tree),
+                          over=_is_event_over(sidebar),
+                          attending=_is_attending(sidebar),
+                          attendee_count=attendee_count,
+                          capacity=capacity,
+                          starts=_event_start(sidebar))
         
+def parse_event_page(content):
+    """
+    Returns:
+    EventPageState: of the event page content, parsed by parser_pool if it 
+        is set, in the calling thread otherwise
+    """
+    if parser_pool:
+        return parser_pool.parse(content)
+    import lxml.html
+    return extract_event_state(lxml.html.fromstring(content))
+
+def _parse_in_worker(content):
+    import lxml.html
+    #a plain tuple is smaller to send back than the pickled class
+    return tuple(extract_event_state(lxml.html.fromstring(content)))
+
+def _ignore_sigint():
+    import signal
+    #Ctrl-C is handled by the main process, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class ParserPool(object):
+    """
+    Process pool parsing event pages out of the threads fetching them.
+
+    The threads only send the page and wait for the few fields of its 
+    EventPageState, so parsing bursts use every core instead of holding the
+    interpreter lock that the network I/O and the joins of the other events
+    need. At most max_pending pages wait for a process: past that, the 
+    fetching threads block until a page is parsed instead of piling up 
+    pages in memory.
+
+    Must be created before any thread is started: the processes are forked.
+    """
+    def __init__(self, processes, max_pending=None):
+        import multiprocessing
+        self._pool = multiprocessing.Pool(processes, _ignore_sigint)
+        self._pending = threading.BoundedSemaphore(max_pending or 
+                                                   2 * processes)
+
+    def parse(self, content):
+        """
+        Returns:
+        EventPageState: of the event page content
+
+        Raises:
+        ParsingError: if no process parsed the page within PARSE_TIMEOUT
+        """
+        if not self._pending.acquire(False):
+            metrics.inc('parser_pool_full_total')
+            self._pending.acquire()
+        try:
+            result = self._pool.apply_async(_parse_in_worker, (content,))
+            deadline = time.time() + PARSE_TIMEOUT
+            #waiting with a timeout keeps Ctrl-C working
+            while not result.ready():
+                left = deadline - time.time()
+                if left <= 0:
+                    #the pool replaces a process that died (killed, crashed)
+                    #but loses the page it was parsing
+                    metrics.inc('parser_timeouts_total')
+                    raise ParsingError("No process parsed the page within "
+                                       "{0}s".format(PARSE_TIMEOUT))
+                result.wait(min(CONTROL_TIMEOUT, left))
+            return EventPageState(*result.get())
+        finally:
+            self._pending.release()
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+#set by main with --parse-processes
+parser_pool = None
+
+JOIN_DATA = {'source':'show_page'}
+#join latencies remembered per event
+LATENCY_HISTORY = 100
+
+def _join_response(r, probe=False):
+    """
+    Args:
+    probe (bool): the event page wasn't retrieved just before, so nothing 
+        says the session is still logged in. Only a JSON answer that wasn't
+        redirected (to the login page) counts as joined
+
+    Returns:
+    (bool, bool): whether the event was joined and whether the server said 
+        the event is full
+    """
+    #if full response = 200 with content '{"error":"This event is full."}'
+    try:
+        answer = r.json()
+    except ValueError:
+        answer = None
+    is_full = answer is not None and 'This event is full' in answer.get(
+        'error', '')
+    joined = r.status_code == 200 and not is_full
+    if probe:
+        joined = joined and answer is not None and not r.history
+    return (joined, is_full)
+
 def join_event(session, event):
+    from requests.exceptions import RequestException
     try:
-        r = session.post(event + '/join', 
-                         data={'source':'show_page'}
-                         )
+        with metrics.timer('join_seconds', event=event):
+            r = session.post(event + '/join', 
+                             data=JOIN_DATA
+                             )
     except RequestException, e:
+        metrics.inc('joins_total', event=event, outcome='error')
         print "Error retrieving page {0}".format(e)
-        return false
+        return False
     else:
-        #if full response = 200 with content '{"error":"This event is full."}'
-        try:
-            is_full = 'This event is full' in r.json().get('error', '')
-        except ValueError:
-            is_full = False
-        if r.status_code == 200 and not is_full:
-            return True
-        else:
+        (joined, full) = _join_response(r)
+        metrics.inc('joins_total', 
+                    event=event, 
+                    outcome='joined' if joined else 
+                            'full' if full else 'failed')
+        if not joined:
             print "Joining failed.  HTTP code : {0} {1}".format( 
                 r.status_code, r.reason)
+        return joined
+
+class HotJoin(object):
+    """
+    Join request of an event, built in advance so that it can be sent as soon
+    as a free spot is seen.
+
+    The request goes through the same session as the page retrieval and 
+    reuses its keep-alive connection. The join requests of all the events of
+    a session only differ by their URL: one is prepared per session and 
+    copied with the URL of the event when it is sent.
+    """
+    __slots__ = ('session', 'event', 'latencies', 'full')
+    #session -> (prepared join request, arguments of session.send)
+    _prepared = weakref.WeakKeyDictionary()
+
+    def __init__(self, session, event):
+        self.session = session
+        self.event = event
+        #seconds between seeing a free spot and sending the join request
+        self.latencies = collections.deque(maxlen=LATENCY_HISTORY)
+        #the server said the event is full the last time the request was sent
+        self.full = False
+
+    def prepare(self):
+        """
+        Prepare the join request of the session if it isn't yet.
+
+        Returns:
+        requests.PreparedRequest: shared by all the events of the session, 
+            with the URL of the first one prepared
+        """
+        prepared = self._prepared.get(self.session)
+        if prepared is None:
+            import requests
+            request = self.session.prepare_request(
+                requests.Request('POST', self.event + '/join', data=JOIN_DATA))
+            prepared = (request,
+                        self.session.merge_environment_settings(
+                            request.url, {}, None, None, None))
+            self._prepared[self.session] = prepared
+        return prepared[0]
+
+    def _request(self):
+        import requests
+        shared = self.prepare()
+        request = requests.PreparedRequest()
+        request.method = shared.method
+        request.url = self.event + '/join'
+        request.headers = shared.headers.copy()
+        request.body = shared.body
+        request.hooks = shared.hooks
+        #the session cookies change with every login and response. 
+        #prepare_cookies leaves an existing Cookie header alone: without the
+        #pop, the cookie of the session when it was prepared would be sent
+        request.headers.pop('Cookie', None)
+        request.prepare_cookies(self.session.cookies)
+        return request
+
+    def fire(self, detected=None, probe=False):
+        """
+        Send the join request.
+
+        Args:
+        detected (float): time.time() when the free spot was seen
+        probe (bool): sent without retrieving the event page, see 
+            _join_response
+
+        Returns:
+        bool: True if the event was joined
+        """
+        from requests.exceptions import RequestException
+        request = self._request()
+        if detected is not None:
+            self.latencies.append(time.time() - detected)
+            metrics.observe('join_latency_seconds', 
+                            self.latencies[-1], 
+                            event=self.event)
+        self.full = False
+        try:
+            with metrics.timer('join_seconds', event=self.event):
+                r = self.session.send(request, 
+                                      **self._prepared[self.session][1])
+        except RequestException, e:
+            metrics.inc('joins_total', event=self.event, outcome='error')
+            print "Error retrieving page {0}".format(e)
             return False
+        (joined, self.full) = _join_response(r, probe)
+        metrics.inc('joins_total', 
+                    event=self.event, 
+                    outcome='joined' if joined else 
+                            'full' if self.full else 'failed')
+        return joined
+
+def _is_attendee_title(element):
+    parent = element.getparent()
+    return ('event_user_list_title' in (element.get('class') or '') and 
+            parent is not None and
+            'event_attendee_list_container' in (parent.get('class') or ''))
+
+def parse_event_page_stream(chunks):
+    """
+    Parse an event page while it is downloaded.
+
+    Everything extract_event_state needs comes before the attendee counter in
+    the page. Parsing stops as soon as the counter has been read and the rest
+    of the chunks are not consumed.
+
+    Args:
+    chunks (iterable of str): content of a couchsurfing page representing an
+        event
+
+    Returns:
+    EventPageState
+    """
+    import lxml.etree
+    parser = lxml.etree.HTMLPullParser(events=('end',))
+    for chunk in chunks:
+        parser.feed(chunk)
+        if any(_is_attendee_title(element) 
+               for (_, element) in parser.read_events()):
+            break
+    return extract_event_state(parser.close())
 
 class Result(Enum):
     ok = 1
     retry = 2
     abandon = 3
 
-def get_event_page(session, event):
-    try:
-        r = session.get(event)
-    except RequestException, e:
+class PageCache(object):
+    """
+    What is remembered about an event page from one poll to the next.
+
+    Used by get_event_page to send conditional requests and to avoid parsing
+    a page that didn't change, and by poll_event to remember a terminal 
+    result.
+    """
+    __slots__ = ('etag', 'last_modified', 'body_hash', 'state', 'terminal')
+
+    def __init__(self):
+        self.etag = None
+        self.last_modified = None
+        self.body_hash = None
+        self.state = None
+        #(Result, str) of the terminal rule the page matched
+        self.terminal = None
+
+    def request_headers(self):
+        headers = {}
+        if self.state is not None:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+class SharedPageCache(object):
+    """
+    Latest state of the events, shared by the instances of the program 
+    running on the host through a SQLite file.
+
+    Only what is the same for every user is shared: whether the event is 
+    over, its attendee count, its capacity and its start. An entry is fresh 
+    for ttl seconds. Once it is stale, the first instance asking for it gets
+    a lease to retrieve the page again. Until the lease expires, the other 
+    instances keep using the stale entry instead of retrieving the page too.
+    """
+    FIELDS = ('over', 'attendee_count', 'capacity', 'starts')
+
+    def __init__(self, path, ttl=DEFAULT_SHARED_TTL, lease=None):
+        """
+        Args:
+        lease (float): seconds an instance has to put a new state. Default: 
+            ttl
+        """
+        import sqlite3
+        self.ttl = ttl
+        self.lease = ttl if lease is None else lease
+        #tells the leases of this instance from the other ones
+        self.owner = '{0}-{1}'.format(os.getpid(), 
+                                      binascii.hexlify(os.urandom(4)))
+        self._lock = threading.Lock()
+        #transactions are started explicitly, see _transaction
+        #timeout: seconds to wait for the transactions of other instances
+        self._connection = sqlite3.connect(path, 
+                                           timeout=5,
+                                           isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'event TEXT PRIMARY KEY, over INTEGER, attendee_count INTEGER, '
+            'capacity INTEGER, starts TEXT, fetched REAL, lease_owner TEXT, '
+            'lease_until REAL)')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        #IMMEDIATE: the other instances wait instead of claiming the same 
+        #lease between our SELECT and our UPDATE
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._connection
+            except:
+                self._connection.execute('ROLLBACK')
+                raise
+            else:
+                self._connection.execute('COMMIT')
+
+    def claim(self, event):
+        """
+        Look up event and take the lease to refresh it if it is stale and 
+        nobody else has the lease.
+
+        Returns:
+        (dict, bool): fields of EventPageState shared for event, None if 
+            there are none. True if the caller got the lease: it must 
+            retrieve the page and call put or release
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT over, attendee_count, capacity, starts, fetched, '
+                'lease_owner, lease_until FROM pages WHERE event = ?',
+                (event,)).fetchone()
+            fields = None
+            if row and row[4] is not None:
+                starts = row[3] and datetime.datetime.strptime(
+                    row[3], WatchStore.START_FORMAT)
+                fields = {'over': bool(row[0]), 
+                          'attendee_count': row[1], 
+                          'capacity': row[2], 
+                          'starts': starts}
+                if now - row[4] < self.ttl:
+                    return (fields, False)
+            if row and row[5] not in (None, self.owner) and row[6] > now:
+                return (fields, False)
+            connection.execute('INSERT OR IGNORE INTO pages (event) VALUES (?)',
+                               (event,))
+            connection.execute('UPDATE pages SET lease_owner = ?, '
+                               'lease_until = ? WHERE event = ?',
+                               (self.owner, now + self.lease, event))
+        return (fields, True)
+
+    def put(self, event, state):
+        """Share state, retrieved just now, and release the lease"""
+        starts = state.starts and state.starts.strftime(WatchStore.START_FORMAT)
+        with self._transaction() as connection:
+            connection.execute('INSERT OR IGNORE INTO pages (event) VALUES (?)',
+                               (event,))
+            connection.execute(
+                'UPDATE pages SET over = ?, attendee_count = ?, capacity = ?, '
+                'starts = ?, fetched = ?, lease_owner = CASE lease_owner '
+                'WHEN ? THEN NULL ELSE lease_owner END WHERE event = ?',
+                (state.over, state.attendee_count, state.capacity, starts,
+                 time.time(), self.owner, event))
+
+    def release(self, event):
+        """Give up the lease of event, the page couldn't be retrieved"""
+        with self._transaction() as connection:
+            connection.execute('UPDATE pages SET lease_owner = NULL '
+                               'WHERE event = ? AND lease_owner = ?',
+                               (event, self.owner))
+
+    def close(self):
+        self._connection.close()
+
+def get_event_page(session, event, cache=None, stream=False, shared=None):
+    """
+    Retrieve an event page.
+
+    If a PageCache is given the request is conditional. When the server 
+    answers 304 or sends the same page as last time the page isn't parsed
+    again and the state from the previous poll is returned.
+
+    If stream is True the page is parsed while it is downloaded and the 
+    connection is closed once the attendee counter has been read. 
+
+    If a SharedPageCache is given along with a cache holding a state, the page
+    is only retrieved when no other instance on the host did it recently. 
+    Otherwise the state of cache is updated from the shared one.
+
+    Returns:
+    (EventPageState, (Result, str)): state is None unless result is Result.ok
+    """
+    if shared is None:
+        return _fetch_event_page(session, event, cache, stream)
+    if cache and cache.state is not None:
+        (fields, refresh) = shared.claim(event)
+        if not refresh:
+            metrics.inc('shared_cache_hits_total', event=event)
+            if fields:
+                cache.state = cache.state._replace(**fields)
+            return (cache.state, (Result.ok, ''))
+    (state, (result, msg)) = _fetch_event_page(session, event, cache, stream)
+    if result == Result.ok:
+        shared.put(event, state)
+    else:
+        shared.release(event)
+    return (state, (result, msg))
+
+def _fetch_event_page(session, event, cache, stream):
+    from requests.exceptions import RequestException
+    headers = cache.request_headers() if cache else {}
+    try:
+        with metrics.timer('page_fetch_seconds', event=event):
+            r = session.get(event, headers=headers, stream=stream)
+    except RequestException, e:
+        metrics.inc('page_responses_total', event=event, status='error')
         return (None, (Result.retry, "Error retrieving page. {0}".format(e)))
+    metrics.inc('page_responses_total', event=event, status=r.status_code)
+    if stream:
+        try:
+            return _read_streamed_event_page(r, event, cache)
+        except RequestException, e:
+            return (None, (Result.retry, "Error retrieving page. {0}".format(e)))
+        finally:
+            r.close()
+    try:
+        return _read_event_page(r, event, cache)
+    except ParsingError, e:
+        #see ParserPool.parse
+        return (None, (Result.retry, e.message))
+
+def _check_event_page_status(r, event, cache):
+    """
+    Returns:
+    (EventPageState, (Result, str)) if the response has no page to parse, 
+        None otherwise
+    """
+    if r.status_code == 304 and cache and cache.state is not None:
+        metrics.inc('page_unchanged_total', event=event)
+        return (cache.state, (Result.ok, ''))
     if r.status_code == 404:
         return (None, (Result.abandon, "Event doesn't exist ({0})".format(event)))
     if r.status_code != 200:
@@ -242,71 +1504,1589 @@ def get_event_page(session, event):
                     r.status_code, r.reason)
                        )
                 )
-    tree = lxml.html.fromstring(r.content)
-    return (tree, (Result.ok, ''))        
+    if cache:
+        cache.etag = r.headers.get('ETag')
+        cache.last_modified = r.headers.get('Last-Modified')
+    return None
+
+def _read_streamed_event_page(r, event, cache):
+    status = _check_event_page_status(r, event, cache)
+    if status:
+        return status
+    def counted(chunks):
+        for chunk in chunks:
+            metrics.inc('page_bytes_total', len(chunk), event=event)
+            yield chunk
+    with metrics.timer('page_parse_seconds', event=event):
+        state = parse_event_page_stream(
+            counted(r.iter_content(STREAM_CHUNK_SIZE)))
+    if cache:
+        #the page is never read entirely so there's nothing to hash
+        cache.state = state
+        cache.body_hash = None
+    return (state, (Result.ok, ''))
+
+def _read_event_page(r, event, cache):
+    status = _check_event_page_status(r, event, cache)
+    if status:
+        return status
+    metrics.inc('page_bytes_total', len(r.content), event=event)
+    if not cache:
+        with metrics.timer('page_parse_seconds', event=event):
+            state = parse_event_page(r.content)
+        return (state, (Result.ok, ''))
+
+    #md5 is only used to spot identical pages, it's faster than parsing them
+    body_hash = hashlib.md5(r.content).digest()
+    if body_hash != cache.body_hash or cache.state is None:
+        with metrics.timer('page_parse_seconds', event=event):
+            cache.state = parse_event_page(r.content)
+        cache.body_hash = body_hash
+    else:
+        metrics.inc('page_unchanged_total', event=event)
+    return (cache.state, (Result.ok, ''))        
     
-def test_logged_in(tree, username, password, session):
-    if not is_logged_in(tree):
+class SessionManager(object):
+    """
+    Logged in session shared by the watchers of all the events.
+
+    When the session expires every watcher notices it but only the first one
+    logs in again. The others wait for that login and reuse its result 
+    (single flight). After a failed login no new attempt is made before a 
+    backoff delay which doubles with every failure.
+    """
+    MIN_LOGIN_BACKOFF = 60
+    MAX_LOGIN_BACKOFF = 3600
+    #more logins than this within an hour is reported as a login storm
+    LOGIN_STORM = 6
+
+    def __init__(self, session, username, password, session_store=False):
+        """
+        Args:
+        session_store (bool): save the cookies after every login 
+            (see save_cookies)
+        """
+        self.session = session
+        self.username = username
+        self.password = password
+        self.session_store = session_store
+        #incremented after every login
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._login_done = threading.Condition(self._lock)
+        self._logging_in = False
+        self._backoff = 0
+        self._retry_at = 0
+        self._logins = collections.deque()
+
+    def restore(self):
+        """
+        Reuse the session saved by a previous run.
+
+        Returns:
+        bool: True if a saved session was found. It may have expired.
+        """
+        return self.session_store and load_cookies(self.session, 
+                                                   self.username)
+
+    def save(self):
+        if self.session_store:
+            save_cookies(self.session, self.username)
+
+    def login(self):
+        """
+        Raises:
+        requests.exceptions.RequestException: network error
+        LoginException: login failed
+        """
+        login(self.username, self.password, self.session)
+        self._logged_in()
+
+    def relogin(self, generation):
+        """
+        Log in again after a page showed that the session expired.
+
+        Args:
+        generation (int): self.generation when the page was retrieved. 
+            Nothing is done if there has been a login since.
+
+        Raises:
+        requests.exceptions.RequestException: network error
+        LoginException: login failed, or the last one failed too recently
+            to try again
+        """
+        with self._lock:
+            while self._logging_in:
+                self._login_done.wait()
+            if generation != self.generation:
+                return
+            if time.time() < self._retry_at:
+                raise LoginException(
+                    "Last login failed. Next attempt in {0:.0f} seconds".format(
+                        self._retry_at - time.time()))
+            self._logging_in = True
+        metrics.inc('relogins_total')
+        try:
+            login(self.username, self.password, self.session)
+        except LoginException:
+            with self._lock:
+                self._backoff = min(max(self._backoff * 2, 
+                                        self.MIN_LOGIN_BACKOFF),
+                                    self.MAX_LOGIN_BACKOFF)
+                self._retry_at = time.time() + self._backoff
+            raise
+        else:
+            self._logged_in()
+        finally:
+            with self._lock:
+                self._logging_in = False
+                self._login_done.notify_all()
+
+    def _logged_in(self):
+        with self._lock:
+            self.generation += 1
+            self._backoff = 0
+            self._retry_at = 0
+            self._logins.append(time.time())
+        logins = self.logins_last_hour()
+        if logins > self.LOGIN_STORM:
+            print "Warning: {0} logins in the last hour".format(logins)
+        self.save()
+
+    def logins_last_hour(self):
+        with self._lock:
+            while self._logins and self._logins[0] < time.time() - 3600:
+                self._logins.popleft()
+            return len(self._logins)
+
+def test_logged_in(state, manager, generation):
+    """
+    Args:
+    generation (int): manager.generation when the page was retrieved
+    """
+    if not state.logged_in:
+        from requests.exceptions import RequestException
         print "Logged out. Relogging"
         try:
-            login(username, password, session)
+            manager.relogin(generation)
         except RequestException, e:
             return (Result.retry, "Network error when attempting to relog in. {0}".format(e.message))
         except LoginException, e:
-            return(Result.abandon, "Couldn't relog")
+            return (Result.retry, "Couldn't relog. {0}".format(e.message))
     return (Result.ok, '')
-tests=[lambda tree: (Result.abandon, "Event is over") if is_event_over(tree) 
-           else (Result.ok, ''),
-       lambda tree: (Result.abandon, "Already attending event") 
-           if is_attending(tree) 
-           else (Result.ok, ''),
-       lambda tree: (Result.retry, "Event full")
-           if is_event_full(tree)
-           else (Result.ok, '')
-       ]
-
-def loop_to_join_event(session, event, username, password, retry_delay):
+class Rule(object):
+    """
+    A check of the event page state that stops the poll when it matches.
+
+    Args:
+    name (str): name of the rule in the metrics
+    matches (function): takes the EventPageState, returns True when the 
+        rule applies
+    result (Result): result of the poll when the rule applies. A rule giving
+        Result.abandon is terminal: the event can't ever be joined after it
+        matched
+    msg (str): explains the result
+    cost (float): estimated seconds per call, until the rule has been timed
+    """
+    __slots__ = ('name', 'matches', 'result', 'msg', 'cost', 
+                 'calls', 'hits', 'timed', 'seconds', 'reported')
+
+    def __init__(self, name, matches, result, msg, cost=1e-6):
+        self.name = name
+        self.matches = matches
+        self.result = result
+        self.msg = msg
+        self.cost = cost
+        self.calls = 0
+        self.hits = 0
+        #calls timed, and the seconds they took
+        self.timed = 0
+        self.seconds = 0.0
+        #(calls, hits) already added to the metrics
+        self.reported = (0, 0)
+
+    @property
+    def terminal(self):
+        return self.result == Result.abandon
+
+    def rank(self):
+        """
+        Returns:
+        float: expected seconds spent per match. The lower, the earlier the
+            rule runs
+        """
+        cost = self.seconds / self.timed if self.timed else self.cost
+        #Laplace smoothing: rules never seen matching still get a chance
+        return cost * (self.calls + 2) / (self.hits + 1)
+
+class RuleEngine(object):
+    """
+    Runs the Rules on the state of an event page until one matches.
+
+    Terminal rules run first: when a page matches both a terminal rule and 
+    another one, the event is abandoned. Within each group the rules run 
+    cheapest and most often matching first, an order revised from their 
+    statistics every REORDER_EVERY evaluations. Every evaluation counts the
+    calls and hits of the rules, only one in TIME_EVERY is timed. The timed
+    evaluations observe the rule_seconds metric and add the counts since 
+    the last one to rule_calls_total and rule_hits_total.
+    """
+    REORDER_EVERY = 100
+    TIME_EVERY = 10
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._evaluations = 0
+        self._reorder()
+
+    def _reorder(self):
+        self.rules = sorted(self.rules, 
+                            key=lambda rule: (not rule.terminal, rule.rank()))
+
+    def evaluate(self, state):
+        """
+        Returns:
+        (Result, str): of the first rule matching state, (Result.ok, '') if
+            none does
+
+        Raises:
+        ParsingError: see EventPageState.is_full
+        """
+        #counts are approximate with --workers: they only order the rules
+        self._evaluations += 1
+        if self._evaluations % self.REORDER_EVERY == 0:
+            self._reorder()
+        timed = self._evaluations % self.TIME_EVERY == 0
+        try:
+            for rule in self.rules:
+                rule.calls += 1
+                if timed:
+                    start = time.time()
+                    matched = rule.matches(state)
+                    seconds = time.time() - start
+                    rule.timed += 1
+                    rule.seconds += seconds
+                    metrics.observe('rule_seconds', seconds, rule=rule.name)
+                else:
+                    matched = rule.matches(state)
+                if matched:
+                    rule.hits += 1
+                    return (rule.result, rule.msg)
+            return (Result.ok, '')
+        finally:
+            if timed:
+                self._report()
+
+    def _report(self):
+        for rule in self.rules:
+            (calls, hits) = (rule.calls, rule.hits)
+            (reported_calls, reported_hits) = rule.reported
+            if calls > reported_calls:
+                metrics.inc('rule_calls_total', 
+                            calls - reported_calls, 
+                            rule=rule.name)
+            if hits > reported_hits:
+                metrics.inc('rule_hits_total', 
+                            hits - reported_hits, 
+                            rule=rule.name)
+            rule.reported = (calls, hits)
+
+    def stats(self):
+        """
+        Returns:
+        list: of dicts with the name, calls, hits, hit_rate and mean_seconds
+            (of the timed calls) of each rule, in the order they run
+        """
+        return [{'name': rule.name,
+                 'calls': rule.calls,
+                 'hits': rule.hits,
+                 'hit_rate': float(rule.hits) / rule.calls if rule.calls 
+                     else None,
+                 'mean_seconds': rule.seconds / rule.timed if rule.timed 
+                     else None}
+                for rule in self.rules]
+
+#every rule takes the EventPageState of the event page
+rules = RuleEngine([
+        Rule('event_over', 
+             lambda state: state.over, 
+             Result.abandon, 
+             "Event is over"),
+        Rule('attending', 
+             lambda state: state.attending, 
+             Result.abandon, 
+             "Already attending event"),
+        Rule('event_full', 
+             EventPageState.is_full, 
+             Result.retry, 
+             "Event full")
+        ])
+
+class FixedDelay(object):
+    """
+    Always wait the same time between two polls of an event.
+    """
+    __slots__ = ('delay',)
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def next_delay(self, state, now=None):
+        return self.delay
+
+    def set_delay(self, delay):
+        self.delay = delay
+
+    def close(self):
+        pass
+
+class RequestBudget(object):
+    """
+    Number of polls per minute shared by all the watched events.
+    """
+    def __init__(self, polls_per_minute):
+        self.polls_per_minute = polls_per_minute
+        self.watchers = 0
+
+    def min_delay(self):
+        """Shortest delay between two polls of one event within the budget"""
+        return 60.0 * self.watchers / self.polls_per_minute
+
+class AdaptiveDelay(object):
+    """
+    Choose the delay before polling an event again from what happened to it.
+
+    The delay drops to min_delay as soon as the number of attendees changes 
+    (people are leaving and joining, a spot may free up) and is kept short 
+    when the event is about to start. While the number of attendees doesn't 
+    change the delay grows, with some jitter, up to max_delay.
+    """
+    BACKOFF = 1.5
+    JITTER = 0.2
+    #before the event starts, never wait more than this fraction of the time
+    #left until it starts
+    START_FRACTION = 1 / 20.0
+    __slots__ = ('min_delay', 'max_delay', 'budget', 'delay', 'last_count')
+
+    def __init__(self, min_delay, max_delay, budget=None):
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.budget = budget
+        self.delay = min_delay
+        self.last_count = None
+        if budget:
+            budget.watchers += 1
+
+    def next_delay(self, state, now=None):
+        """
+        Args:
+        state (EventPageState): last known state of the event. None if unknown
+        """
+        count = state.attendee_count if state else None
+        if (count is not None and self.last_count is not None and 
+            count != self.last_count):
+            self.delay = self.min_delay
+        else:
+            self.delay = min(self.delay * self.BACKOFF, self.max_delay)
+        if count is not None:
+            self.last_count = count
+
+        delay = self.delay * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+        if state and state.starts:
+            now = now or datetime.datetime.now()
+            left = state.starts - now
+            left = left.days * 86400 + left.seconds
+            if left > 0:
+                delay = min(delay, left * self.START_FRACTION)
+        delay = max(min(delay, self.max_delay), self.min_delay)
+        #the budget is shared by all the events, it wins over max_delay
+        if self.budget:
+            delay = max(delay, self.budget.min_delay())
+        return delay
+
+    def set_delay(self, delay):
+        """Change min_delay"""
+        self.min_delay = delay
+        self.max_delay = max(delay, self.max_delay)
+        self.delay = min(max(self.delay, delay), self.max_delay)
+
+    def close(self):
+        """The event isn't polled anymore"""
+        if self.budget:
+            self.budget.watchers -= 1
+            self.budget = None
+
+def make_delay(retry_delay, max_delay=None, budget=None):
+    """
+    Returns:
+    FixedDelay if max_delay is None, AdaptiveDelay otherwise
+    """
+    if max_delay is None:
+        return FixedDelay(retry_delay)
+    return AdaptiveDelay(retry_delay, max_delay, budget)
+
+def poll_event(manager, event, cache=None, stream=False, joiner=None, 
+               shared=None):
+    """
+    Retrieve the event page once and join the event if there is a free spot.
+
+    The state of the page is checked by rules. An event whose cache already
+    matched a terminal rule gets the same result again, without any request.
+
+    Args:
+    manager (SessionManager): session used for the requests
+    cache (PageCache): remembers the page between calls for the same event
+    stream (bool): see get_event_page
+    joiner (HotJoin): join request of the event, prepared in advance
+    shared (SharedPageCache): see get_event_page
+
+    Returns:
+    (Result, str): Result.ok if the event was joined, Result.retry if the 
+        event must be polled again, Result.abandon if it can't be joined. 
+        The string explains the result.
+    """
+    if cache and cache.terminal:
+        return cache.terminal
+    generation = manager.generation
+    (state, page_retrieval_result) = get_event_page(manager.session, 
+                                                    event, 
+                                                    cache, 
+                                                    stream,
+                                                    shared)
+    detected = time.time()
+    (result, msg) = page_retrieval_result
+    if result != Result.ok:
+        return (result, msg)
+    with metrics.timer('check_seconds', check='logged_in', event=event):
+        (result, msg) = test_logged_in(state, manager, generation)
+    if result != Result.ok:
+        return (result, msg)
+    try:
+        (result, msg) = rules.evaluate(state)
+    except ParsingError, e:
+        #only this event: the other watches go on
+        return (Result.retry, e.message)
+    if result == Result.abandon and cache:
+        cache.terminal = (result, msg)
+    if result != Result.ok:
+        return (result, msg)
+    joiner = joiner or HotJoin(manager.session, event)
+    joined = joiner.fire(detected)
+    latency = "(join request sent {0:.1f} ms after the page was read)".format(
+        joiner.latencies[-1] * 1000)
+    if joined:
+        return (Result.ok, "Joined event! " + latency)
+    return (Result.retry, "Failed joining " + latency)
+
+class EventWatch(object):
+    """
+    Everything remembered about a watched event from one poll to the next.
+
+    If probe_every is given, only one poll out of probe_every retrieves the 
+    event page. While that page shows a full event that could be joined 
+    otherwise, the other polls just send the join request: it either joins 
+    or answers that the event is still full.
+    """
+    #one per watched event, thousands of them may be alive
+    __slots__ = ('manager', 'event', 'delay', 'stream', 'probe_every', 'shared',
+                 'cache', 'joiner', 'last_poll', '_polls_since_page')
+
+    def __init__(self, manager, event, delay, stream=False, probe_every=None, 
+                 shared=None):
+        """
+        Args:
+        delay (FixedDelay or AdaptiveDelay): chooses the delay between polls
+        shared (SharedPageCache): see get_event_page
+        """
+        self.manager = manager
+        self.event = event
+        self.delay = delay
+        self.stream = stream
+        self.probe_every = probe_every
+        self.shared = shared
+        self.cache = PageCache()
+        self.joiner = HotJoin(manager.session, event)
+        self.joiner.prepare()
+        #(Result, str) of the last poll
+        self.last_poll = None
+        self._polls_since_page = 0
+
+    def _can_probe(self):
+        state = self.cache.state
+        return (self.probe_every is not None and
+                self._polls_since_page < self.probe_every - 1 and
+                self.joiner.full and
+                state is not None and
+                state.logged_in and
+                not state.over and
+                not state.attending)
+
+    def poll(self):
+        """
+        Returns:
+        (Result, str): see poll_event
+        """
+        start = time.time()
+        previous = self.cache.state
+        (result, msg) = self._poll()
+        #an unchanged page gives back the same state object: nothing to compare
+        if change_feed and (self.cache.state is not previous or 
+                            result == Result.ok):
+            change_feed.record(self.event, 
+                               previous, 
+                               self.cache.state, 
+                               result == Result.ok)
+        metrics.observe('poll_seconds', 
+                        time.time() - start, 
+                        event=self.event, 
+                        result=result.name)
+        metrics.inc('polls_total', event=self.event, result=result.name)
+        self.last_poll = (result, msg)
+        return (result, msg)
+
+    def _poll(self):
+        if self._can_probe():
+            self._polls_since_page += 1
+            #a failed probe clears joiner.full: the next poll gets the page
+            if self.joiner.fire(probe=True):
+                return (Result.ok, "Joined event!")
+            if self.joiner.full:
+                return (Result.retry, "Event full")
+            return (Result.retry, "Failed joining")
+        self._polls_since_page = 0
+        self.joiner.full = False
+        (result, msg) = poll_event(self.manager, 
+                                   self.event, 
+                                   self.cache, 
+                                   self.stream, 
+                                   self.joiner,
+                                   self.shared)
+        if result == Result.retry and self.cache.state is not None:
+            try:
+                #a full page means the next polls can be probes
+                self.joiner.full = self.cache.state.is_full()
+            except ParsingError:
+                pass
+        return (result, msg)
+
+    def next_delay(self):
+        return self.delay.next_delay(self.cache.state)
+
+    def close(self):
+        self.delay.close()
+
+def state_changes(previous, state, joined=False):
+    """
+    Args:
+    previous (EventPageState): of the poll before. None if there wasn't any
+    state (EventPageState): of the last poll
+    joined (bool): the last poll joined the event
+
+    Returns:
+    list: names of what changed: 'seen' (first known state), 'attendees', 
+        'capacity', 'over', 'logged_out', 'logged_in', 'attending', 'joined'
+    """
+    changes = []
+    if joined:
+        changes.append('joined')
+    if state is None:
+        return changes
+    if previous is None:
+        return ['seen'] + changes
+    if state.attendee_count != previous.attendee_count:
+        changes.append('attendees')
+    if state.capacity != previous.capacity:
+        changes.append('capacity')
+    if state.over and not previous.over:
+        changes.append('over')
+    if state.logged_in != previous.logged_in:
+        changes.append('logged_in' if state.logged_in else 'logged_out')
+    if state.attending and not previous.attending:
+        changes.append('attending')
+    return changes
+
+class ChangeFeed(object):
+    """
+    Stream of JSON lines, one each time a poll finds an event different from
+    the poll before (see state_changes). Events that don't change write 
+    nothing.
+
+    Each line has the event, the time (time.time()), the list of changes, 
+    whether the event was joined and the fields of the EventPageState. The
+    lines are buffered and written by a background thread every 
+    flush_interval seconds, and when the feed is closed.
+    """
+    def __init__(self, sink, flush_interval=FEED_FLUSH_INTERVAL):
+        """
+        Args:
+        sink (file): where the lines are written. Closed with the feed
+        """
+        self._sink = sink
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically,
+                                         args=(flush_interval,))
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_periodically(self, interval):
+        while not self._closed.wait(interval):
+            self.flush()
+
+    def record(self, event, previous, state, joined=False):
+        """Write a line if state differs from previous. See state_changes"""
+        changes = state_changes(previous, state, joined)
+        if not changes:
+            return
+        line = {'event': event, 
+                'time': time.time(), 
+                'changes': changes, 
+                'joined': joined}
+        if state is not None:
+            line.update(state._asdict())
+            if state.starts is not None:
+                line['starts'] = state.starts.strftime(
+                    WatchStore.START_FORMAT)
+        line = json.dumps(line, sort_keys=True) + '\n'
+        with self._lock:
+            self._sink.write(line)
+
+    def flush(self):
+        with self._lock:
+            self._sink.flush()
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        self._sink.close()
+
+#set by main with --feed
+change_feed = None
+
+class WatchStore(object):
+    """
+    SQLite database remembering the watched events across restarts.
+
+    For every event it keeps the last EventPageState, what is needed for 
+    conditional requests, the state of the AdaptiveDelay and when the event
+    must be polled next. Saved watches are only written to the database by a
+    background thread every flush_interval seconds, in one transaction.
+    """
+    FIELDS = ('event', 'logged_in', 'over', 'attending', 'attendee_count',
+              'capacity', 'starts', 'etag', 'last_modified', 'body_hash',
+              'delay', 'last_count', 'next_due', 'result')
+    START_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, path, flush_interval=5):
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS watches ('
+            'event TEXT PRIMARY KEY, logged_in INTEGER, over INTEGER, '
+            'attending INTEGER, attendee_count INTEGER, capacity INTEGER, '
+            'starts TEXT, etag TEXT, last_modified TEXT, body_hash BLOB, '
+            'delay REAL, last_count INTEGER, next_due REAL, result TEXT)')
+        self._connection.commit()
+        self._lock = threading.Lock()
+        #event -> row waiting to be written
+        self._pending = {}
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically,
+                                         args=(flush_interval,))
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _flush_periodically(self, interval):
+        while not self._closed.wait(interval):
+            self.flush()
+
+    def load(self, event):
+        """
+        Returns:
+        dict: what was saved about event, None if nothing was
+        """
+        with self._lock:
+            row = self._pending.get(event)
+            if row is None:
+                row = self._connection.execute(
+                    'SELECT {0} FROM watches WHERE event = ?'.format(
+                        ', '.join(self.FIELDS)), 
+                    (event,)).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    def restore(self, watch):
+        """
+        Put back in watch what was saved about its event.
+
+        Returns:
+        dict: what was saved about the event, None if nothing was
+        """
+        saved = self.load(watch.event)
+        if not saved:
+            return None
+        if saved['logged_in'] is not None:
+            starts = saved['starts'] and datetime.datetime.strptime(
+                saved['starts'], self.START_FORMAT)
+            watch.cache.state = EventPageState(
+                logged_in=bool(saved['logged_in']),
+                over=bool(saved['over']),
+                attending=bool(saved['attending']),
+                attendee_count=saved['attendee_count'],
+                capacity=saved['capacity'],
+                starts=starts)
+            watch.cache.etag = saved['etag']
+            watch.cache.last_modified = saved['last_modified']
+            watch.cache.body_hash = saved['body_hash'] and \
+                str(saved['body_hash'])
+        if isinstance(watch.delay, AdaptiveDelay) and saved['delay']:
+            watch.delay.delay = saved['delay']
+            watch.delay.last_count = saved['last_count']
+        return saved
+
+    def save(self, watch, next_due, result=None):
+        """
+        Remember the current state of watch. Written to the database later.
+
+        Args:
+        next_due (float): when the event must be polled next (time.time())
+        result (Result): final result of the watch if it is over
+        """
+        state = watch.cache.state
+        delay = watch.delay if isinstance(watch.delay, AdaptiveDelay) else None
+        row = (watch.event,
+               state and state.logged_in,
+               state and state.over,
+               state and state.attending,
+               state and state.attendee_count,
+               state and state.capacity,
+               state and state.starts and 
+                   state.starts.strftime(self.START_FORMAT),
+               watch.cache.etag,
+               watch.cache.last_modified,
+               watch.cache.body_hash and buffer(watch.cache.body_hash),
+               delay and delay.delay,
+               delay and delay.last_count,
+               next_due,
+               result and result.name)
+        with self._lock:
+            self._pending[watch.event] = row
+
+    def forget(self, event):
+        with self._lock:
+            self._pending.pop(event, None)
+            self._connection.execute('DELETE FROM watches WHERE event = ?', 
+                                     (event,))
+            self._connection.commit()
+
+    def flush(self):
+        """Write the saved watches to the database"""
+        with self._lock:
+            rows = self._pending.values()
+            self._pending = {}
+            if rows:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO watches ({0}) VALUES ({1})'.format(
+                        ', '.join(self.FIELDS), 
+                        ', '.join('?' * len(self.FIELDS))),
+                    rows)
+                self._connection.commit()
+
+    def events(self):
+        """
+        Returns:
+        list: events saved and not done, the most urgent first
+        """
+        self.flush()
+        with self._lock:
+            return [event for (event,) in self._connection.execute(
+                    'SELECT event FROM watches WHERE result IS NULL '
+                    'ORDER BY next_due')]
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        self._connection.close()
+
+def loop_to_join_event(manager, event, retry_delay,
+                       stream=False, max_delay=None, budget=None, 
+                       probe_every=None, store=None, shared=None):
+    """
+    Poll event until it is joined or can't be joined.
+
+    Polls are retry_delay seconds apart. If max_delay is given, the delay 
+    adapts to the event between retry_delay and max_delay (see AdaptiveDelay)
+    without going over budget polls per minute. See EventWatch for 
+    probe_every.
+
+    Args:
+    store (WatchStore): the watch resumes from and is saved in store
+    shared (SharedPageCache): see get_event_page
+    """
+    watch = EventWatch(manager, 
+                       event, 
+                       make_delay(retry_delay, 
+                                  max_delay, 
+                                  RequestBudget(budget) if budget else None),
+                       stream,
+                       probe_every,
+                       shared)
+    wait = _resume(watch, store)
+    if wait is None:
+        return
+    time.sleep(wait)
     while True:
-        (tree, page_retrieval_result) = get_event_page(session, event)
-        #prepend test with result of retrieving the page and curried logged_in
-        all_tests = [lambda _: page_retrieval_result] + \
-                    [lambda tree: test_logged_in(tree, username, password, session)] + \
-                    tests
-
-        for test in all_tests:
-            (result, msg) = test(tree)
-            if result != Result.ok:
-                print msg
-                if result == Result.abandon:
-                    return
-                if result == Result.retry:
-                    break
-        else:#no break in loop
-            if(join_event(session, event)):
-                print "Joined event!"
+        (result, msg) = watch.poll()
+        print msg
+        if result != Result.retry:
+            if store:
+                store.save(watch, None, result)
+            return
+        wait = watch.next_delay()
+        if store:
+            store.save(watch, time.time() + wait)
+        print "Retrying in {0:.0f} seconds".format(wait)
+        time.sleep(wait)            
+
+def _resume(watch, store):
+    """
+    Restore watch from store.
+
+    Returns:
+    float: seconds to wait before the first poll. None if the watch was 
+        already over.
+    """
+    saved = store and store.restore(watch)
+    if not saved:
+        return 0
+    if saved['result']:
+        print "{0}: already done ({1}) in a previous run".format(
+            watch.event, saved['result'])
+        return None
+    return max(0, (saved['next_due'] or 0) - time.time())
+
+def watch_event(manager, event, retry_delay, 
+                stream=False, max_delay=None, budget=None, probe_every=None,
+                store=None, shared=None):
+    """
+    Coroutine version of loop_to_join_event.
+
+    Instead of sleeping, yields the number of seconds to wait before the event
+    must be polled again. Meant to be driven by a Scheduler. With a store, 
+    the first value yielded is the wait before the first poll.
+
+    Args:
+    budget (RequestBudget): shared by the watchers of all the events
+    """
+    watch = EventWatch(manager, 
+                       event, 
+                       make_delay(retry_delay, max_delay, budget),
+                       stream,
+                       probe_every,
+                       shared)
+    return _drive_watch(watch, store)
+
+def _drive_watch(watch, store=None):
+    """Generator behind watch_event"""
+    try:
+        if store:
+            wait = _resume(watch, store)
+            if wait is None:
+                return
+            yield wait
+        while True:
+            (result, msg) = watch.poll()
+            #a single write: lines of concurrent watchers don't mix
+            sys.stdout.write("{0}: {1}\n".format(watch.event, msg))
+            if result != Result.retry:
+                if store:
+                    store.save(watch, None, result)
+                return
+            wait = watch.next_delay()
+            if store:
+                store.save(watch, time.time() + wait)
+            yield wait
+    finally:
+        watch.close()
+
+class Scheduler(object):
+    """
+    Drive the watch_event coroutines of several events from a single loop.
+
+    The next due time of every event is kept in a priority queue. Polls are
+    run in due order, events due at the same time in the order they were 
+    scheduled. The loop only sleeps until the next event is due, or until an
+    event read by add_from comes.
+    """
+    def __init__(self):
+        self._queue = []
+        #event -> (watcher, due, number of its live entry in the queue)
+        self._watchers = {}
+        #breaks ties so that events are polled in the order they were queued
+        self._counter = itertools.count()
+        #events read by add_from, None once they are all read
+        self._incoming = Queue.Queue()
+        self._watcher_for = None
+        self._reading = False
+
+    def __len__(self):
+        return len(self._watchers)
+
+    def __contains__(self, event):
+        return event in self._watchers
+
+    def add(self, event, watcher, due=None):
+        """
+        Args:
+        event (str): key of the watcher. Normally the event URL
+        watcher (generator): yields the delay before the next poll
+        due (float): when to poll first (time.time()). Default: now
+        """
+        self._push(event, watcher, time.time() if due is None else due)
+
+    def add_from(self, events, watcher_for):
+        """
+        Add the events of an iterable as they are read, while polling the 
+        events already added. events is read in a thread: reading it may 
+        block (a pipe) without holding up the polls.
+
+        Args:
+        watcher_for (function): takes an event, returns its watcher
+        """
+        self._watcher_for = watcher_for
+        self._reading = True
+        reader = threading.Thread(target=self._read, args=(events,))
+        reader.daemon = True
+        reader.start()
+
+    def _read(self, events):
+        try:
+            for event in events:
+                self._put_incoming(event)
+        finally:
+            self._put_incoming(None)
+
+    def _put_incoming(self, event):
+        self._incoming.put(event)
+
+    def _take(self, event):
+        """Add an event read by add_from in the loop. None: all are read"""
+        if event is None:
+            self._reading = False
+        elif event not in self:
+            self.add(event, self._watcher_for(event))
+
+    def _wait(self, timeout):
+        """
+        Sleep until timeout (seconds, None: no limit) or until events are 
+        read by add_from, and add them.
+        """
+        if not self._reading:
+            if timeout:
+                time.sleep(timeout)
+            return
+        try:
+            #a blocking get without timeout can't be interrupted by Ctrl-C
+            self._take(self._incoming.get(True, 
+                                          CONTROL_TIMEOUT if timeout is None 
+                                          else timeout))
+        except Queue.Empty:
+            return
+        self._take_incoming()
+
+    def _take_incoming(self):
+        """Add the events read by add_from so far"""
+        while self._reading:
+            try:
+                self._take(self._incoming.get(False))
+            except Queue.Empty:
                 return
+
+    def remove(self, event):
+        (watcher, _, _) = self._watchers.pop(event, (None, None, None))
+        if watcher:
+            watcher.close()
+
+    def due(self, event):
+        """
+        Returns:
+        float: when event is polled next (time.time()). None if it isn't 
+            scheduled
+        """
+        return self._watchers[event][1] if event in self._watchers else None
+
+    def reschedule(self, event, due):
+        """Poll event at due instead of when it was planned"""
+        self._push(event, self._watchers[event][0], due)
+
+    def next_due(self):
+        """
+        Returns:
+        float: when the next event is due (time.time()). None if there is none
+        """
+        self._drop_stale()
+        return self._queue[0][0] if self._queue else None
+
+    def _push(self, event, watcher, due):
+        number = next(self._counter)
+        self._watchers[event] = (watcher, due, number)
+        heapq.heappush(self._queue, (due, number, event, watcher))
+
+    def _drop_stale(self):
+        #entries of events removed or rescheduled since they were queued
+        while self._queue:
+            (_, number, event, _) = self._queue[0]
+            if event in self._watchers and self._watchers[event][2] == number:
+                return
+            heapq.heappop(self._queue)
+
+    def run_once(self):
+        """
+        Wait for the next due event and poll it. While add_from reads events,
+        returns without polling when events come first.
+        """
+        self._take_incoming()
+        self._drop_stale()
+        if not self._queue:
+            self._wait(None)
+            return
+        wait = self._queue[0][0] - time.time()
+        if wait > 0 and self._reading:
+            self._wait(wait)
+            return
+        (due, _, event, watcher) = heapq.heappop(self._queue)
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            retry_delay = next(watcher)
+        except StopIteration:
+            del self._watchers[event]
+            return
+        self._push(event, watcher, time.time() + retry_delay)
+
+    def run(self):
+        """Poll until every watcher is done and add_from read every event"""
+        while self._queue or self._reading:
+            self.run_once()
+
+class ConcurrentScheduler(Scheduler):
+    """
+    Scheduler running up to workers polls at the same time, each one in a 
+    worker thread. The loop hands the due events to the workers and 
+    reschedules them when their poll is over. An event is never polled by two
+    workers at once.
+
+    A Scheduler waits for every network round trip, so it can't poll more 
+    than about one event per round trip. This one polls workers times more.
+    """
+    def __init__(self, workers):
+        super(ConcurrentScheduler, self).__init__()
+        self.workers = workers
+        #event -> watcher being polled
+        self._in_flight = {}
+        self._todo = Queue.Queue()
+        #(event, watcher, retry delay or None, sys.exc_info() or None), and
+        #(event, None, None, None) for the events read by add_from
+        self._done = Queue.Queue()
+        self._threads = []
+
+    def remove(self, event):
+        if event in self._in_flight:
+            #a running generator can't be closed: done when its poll ends
+            self._watchers.pop(event, None)
+        else:
+            super(ConcurrentScheduler, self).remove(event)
+
+    def _work(self):
+        while True:
+            job = self._todo.get()
+            if job is None:
+                return
+            (event, watcher) = job
+            try:
+                self._done.put((event, watcher, next(watcher), None))
+            except StopIteration:
+                self._done.put((event, watcher, None, None))
+            except Exception:
+                self._done.put((event, watcher, None, sys.exc_info()))
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _put_incoming(self, event):
+        #wakes the loop waiting for the workers
+        self._done.put((event, None, None, None))
+
+    def close(self):
+        """Stop the worker threads once their current poll is over"""
+        for _ in self._threads:
+            self._todo.put(None)
+        for thread in self._threads:
+            #a worker stuck on the network is a daemon thread: not waited for
+            thread.join(CONTROL_TIMEOUT)
+        self._threads = []
+
+    def run_once(self):
+        """
+        Hand the due events to the free workers, then wait for a poll to end,
+        for the next event to be due or for an event read by add_from.
+        """
+        self._start()
+        self._drop_stale()
+        now = time.time()
+        while (self._queue and self._queue[0][0] <= now and 
+               len(self._in_flight) < self.workers):
+            (_, _, event, watcher) = heapq.heappop(self._queue)
+            #rescheduled while polled: rescheduled anyway when done
+            if event not in self._in_flight:
+                self._in_flight[event] = watcher
+                self._todo.put((event, watcher))
+            self._drop_stale()
+        due = self.next_due()
+        if not self._in_flight and not self._reading:
+            if due is not None:
+                time.sleep(max(0, due - time.time()))
+            return
+        if due is None or len(self._in_flight) >= self.workers:
+            #a blocking get without timeout can't be interrupted by Ctrl-C
+            timeout = CONTROL_TIMEOUT
+        else:
+            timeout = max(0, due - time.time())
+        try:
+            (event, watcher, retry_delay, error) = self._done.get(True, 
+                                                                  timeout)
+        except Queue.Empty:
+            return
+        if watcher is None:
+            self._take(event)
+            return
+        del self._in_flight[event]
+        current = self._watchers.get(event, (None, None, None))[0]
+        if current is not watcher:
+            #removed or replaced while polled
+            watcher.close()
+        elif retry_delay is None:
+            del self._watchers[event]
+        else:
+            self._push(event, watcher, time.time() + retry_delay)
+        if error:
+            raise error[0], error[1], error[2]
+
+    def run(self):
+        """Poll until every watcher is done and add_from read every event"""
+        try:
+            while self._queue or self._in_flight or self._reading:
+                self.run_once()
+        finally:
+            self.close()
+
+def watch_events(manager, events, retry_delay, 
+                 stream=False, max_delay=None, budget=None, probe_every=None,
+                 store=None, shared=None, workers=1):
+    """
+    Try to join every event in events, sharing the session of manager 
+    between them.
+
+    Args:
+    events (iterable): event URLs. Each one is watched as soon as it is 
+        read, while the events read before are polled
+    budget (int): maximum number of polls per minute for all the events
+    workers (int): number of polls run at the same time
+    """
+    shared_budget = RequestBudget(budget) if budget else None
+    scheduler = ConcurrentScheduler(workers) if workers > 1 else Scheduler()
+    scheduler.add_from(events, lambda event: watch_event(manager, 
+                                                         event, 
+                                                         retry_delay, 
+                                                         stream,
+                                                         max_delay,
+                                                         shared_budget,
+                                                         probe_every,
+                                                         store,
+                                                         shared))
+    scheduler.run()
+
+def _bind_control_socket(path):
+    """
+    Returns:
+    SocketServer.UnixStreamServer: listening on path, only usable by the 
+        current user
+
+    Raises:
+    socket.error: if another daemon listens on path
+    """
+    import socket
+    import SocketServer
+
+    class ControlHandler(SocketServer.StreamRequestHandler):
+        #a client can't hold the polls for longer than that
+        timeout = CONTROL_TIMEOUT
+
+        def handle(self):
+            try:
+                line = self.rfile.readline(4096)
+                self.wfile.write(self.server.owner.command(line) + '\n')
+            except socket.error:
+                #client too slow or gone
+                pass
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise socket.error(errno.EEXIST, path + " isn't a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error, e:
+            if e.errno != errno.ECONNREFUSED:
+                raise
+            #left by a daemon that didn't stop cleanly
+            os.remove(path)
+        else:
+            raise socket.error(errno.EADDRINUSE, 
+                               "A daemon already listens on " + path)
+        finally:
+            probe.close()
+    umask = os.umask(0077)
+    try:
+        return SocketServer.UnixStreamServer(path, ControlHandler)
+    finally:
+        os.umask(umask)
+
+def send_command(command, path=CONTROL_SOCKET, timeout=CONTROL_TIMEOUT):
+    """
+    Send command to the daemon listening on path.
+
+    Returns:
+    str: answer of the daemon
+
+    Raises:
+    socket.error: if no daemon listens on path
+    """
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall(command + '\n')
+        chunks = []
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+    finally:
+        client.close()
+
+class Daemon(object):
+    """
+    Watch events for as long as it runs, taking commands on a Unix socket.
+
+    Commands are one line, one per connection:
+      add URL           watch URL
+      remove URL        stop watching URL
+      delay URL SECONDS poll URL every SECONDS (the shortest delay with 
+                        max_delay)
+      list              one line per event: next poll and last result
+      stop              stop the daemon
+    Commands are served by the polling loop itself, between two polls, so 
+    watchers never run concurrently. Adding an event costs neither a new
+    process nor a new login.
+    """
+    def __init__(self, manager, path, retry_delay, stream=False, 
+                 max_delay=None, budget=None, probe_every=None, store=None,
+                 shared=None):
+        self.manager = manager
+        self.path = path
+        self.retry_delay = retry_delay
+        self.stream = stream
+        self.max_delay = max_delay
+        self.budget = RequestBudget(budget) if budget else None
+        self.probe_every = probe_every
+        self.store = store
+        self.shared = shared
+        self.scheduler = Scheduler()
+        #event -> EventWatch, finished ones included until removed
+        self.watches = collections.OrderedDict()
+        self.stopped = False
+        self._server = _bind_control_socket(path)
+        self._server.owner = self
+
+    def add(self, event):
+        """
+        Raises:
+        ValueError: if event isn't the URL of an event
+        """
+        event = normalize_event_url(event)
+        if event in self.scheduler:
+            return "{0} already watched".format(event)
+        if event in self.watches:
+            self.watches.pop(event).close()
+        watch = EventWatch(self.manager,
+                           event,
+                           make_delay(self.retry_delay, 
+                                      self.max_delay, 
+                                      self.budget),
+                           self.stream,
+                           self.probe_every,
+                           self.shared)
+        self.watches[event] = watch
+        self.scheduler.add(event, _drive_watch(watch, self.store))
+        return "Watching {0}".format(event)
+
+    def remove(self, event):
+        """
+        Stop watching event and forget what was saved about it.
+
+        Raises:
+        ValueError: if event isn't watched
+        """
+        event = normalize_event_url(event)
+        if event not in self.watches:
+            raise ValueError("{0} isn't watched".format(event))
+        self.scheduler.remove(event)
+        self.watches.pop(event).close()
+        if self.store:
+            self.store.forget(event)
+        return "Stopped watching {0}".format(event)
+
+    def set_delay(self, event, delay):
+        """
+        Raises:
+        ValueError: if event isn't watched or delay is too short
+        """
+        event = normalize_event_url(event)
+        delay = int(delay)
+        if delay < MIN_RETRY_DELAY:
+            raise ValueError(
+                "Minimum allowed delay is {0}".format(MIN_RETRY_DELAY))
+        if event not in self.watches:
+            raise ValueError("{0} isn't watched".format(event))
+        self.watches[event].delay.set_delay(delay)
+        due = self.scheduler.due(event)
+        if due is not None and due > time.time() + delay:
+            self.scheduler.reschedule(event, time.time() + delay)
+        return "Polling {0} every {1} seconds".format(event, delay)
+
+    def status(self):
+        lines = []
+        now = time.time()
+        for (event, watch) in self.watches.iteritems():
+            msg = watch.last_poll[1] if watch.last_poll else 'not polled yet'
+            due = self.scheduler.due(event)
+            if due is None:
+                lines.append("{0} done: {1}".format(event, msg))
             else:
-                print "Failed joining"
-        print "Retrying in {0} seconds".format(retry_delay)
-        time.sleep(retry_delay)            
+                lines.append("{0} next poll in {1:.0f}s: {2}".format(
+                        event, max(0, due - now), msg))
+        return '\n'.join(lines) or 'No event watched'
+
+    def stop(self):
+        self.stopped = True
+        return "Stopping"
+
+    def command(self, line):
+        """
+        Run one command of the control socket.
+
+        Returns:
+        str: answer to the client
+        """
+        commands = {'add': self.add,
+                    'remove': self.remove,
+                    'delay': self.set_delay,
+                    'list': self.status,
+                    'stop': self.stop}
+        words = line.split()
+        if not words or words[0] not in commands:
+            return "error: expecting one of {0}".format(
+                ', '.join(sorted(commands)))
+        handler = commands[words[0]]
+        #self excluded. Checked before the call: a TypeError raised by the 
+        #handler is a bug, reported by the server, not a usage error
+        if len(words) - 1 != handler.__func__.__code__.co_argcount - 1:
+            return "error: wrong number of arguments for " + words[0]
+        try:
+            return handler(*words[1:])
+        except ValueError, e:
+            return "error: {0}".format(e.message)
+
+    def run(self):
+        """Poll and serve commands until stop"""
+        try:
+            while not self.stopped:
+                due = self.scheduler.next_due()
+                #wait for a command until the next event is due
+                self._server.timeout = (None if due is None 
+                                        else max(0, due - time.time()))
+                self._server.handle_request()
+                due = self.scheduler.next_due()
+                if due is not None and due <= time.time():
+                    self.scheduler.run_once()
+        finally:
+            self.close()
+
+    def close(self):
+        for event in self.watches:
+            self.scheduler.remove(event)
+            self.watches[event].close()
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def _send_events(events, path):
+    """
+    Send an add command to the daemon listening on path for each event, as
+    the events are read.
+    """
+    import socket
+    for event in events:
+        try:
+            #the daemon answers between two polls
+            answer = send_command('add ' + event, path, None)
+        except socket.error:
+            #stopped
+            return
+        if answer.startswith('error'):
+            sys.stderr.write("{0}: {1}\n".format(event, answer))
+
+def run_daemon(manager, events, values, store=None, shared=None):
+    """
+    Watch the events left unfinished in store and events, then take commands
+    on the control socket until stopped.
+
+    Args:
+    events (iterable): event URLs. Read by a thread which adds each one to
+        the daemon through the control socket as soon as it is read
+    """
+    import socket
+    try:
+        daemon = Daemon(manager,
+                        values['daemon'],
+                        values['delay'],
+                        values['stream'],
+                        values['max_delay'],
+                        values['budget'],
+                        values['probe_join'],
+                        store,
+                        shared)
+    except socket.error, e:
+        print "Couldn't open the control socket. {0}".format(e)
+        return
+    for event in store.events() if store else []:
+        daemon.add(event)
+    reader = threading.Thread(target=_send_events, 
+                              args=(events, values['daemon']))
+    reader.daemon = True
+    reader.start()
+    print "Waiting for commands on {0}".format(values['daemon'])
+    daemon.run()
 
 def main():
+    global parser_pool, change_feed
     values = get_user_values()
+    #before the metrics threads: the parsing processes are forked
+    if values['parse_processes']:
+        parser_pool = ParserPool(values['parse_processes'])
 
+    from requests.exceptions import RequestException
+    recorder = None
+    #closed even if the login fails
     try:
+        if values['feed'] == '-':
+            change_feed = ChangeFeed(os.fdopen(os.dup(sys.stdout.fileno()), 
+                                               'w', 
+                                               65536))
+            sys.stdout = sys.stderr
+        elif values['feed']:
+            change_feed = ChangeFeed(open(values['feed'], 'a', 65536))
+        if values['metrics_port']:
+            serve_metrics(values['metrics_port'])
+        if values['metrics_file']:
+            dump_metrics_periodically(values['metrics_file'], 
+                                      values['metrics_interval'])
+
         global session #testing
         if not 'session' in vars():
-            session = login(values['username'], values['password'])        
+            session = make_session(values['max_rate'], 
+                                   max(DEFAULT_POOL_SIZE, values['workers']))
+        if values['record']:
+            recorder = record_session(session, values['record'])
+        manager = SessionManager(session, 
+                                 values['username'], 
+                                 values['password'],
+                                 values['session_store'])
+        #a dead saved session is noticed on the first event page and 
+        #the event loop logs in again
+        if not manager.restore():
+            manager.login()
     except RequestException, e:
         print "Network error when attempting to login. {0}".format(e.message)
     except LoginException, e:
         print "Couldn't login. {0}".format(e.message)
     else:
-        loop_to_join_event(session,
-                           values['event'],
-                           values['username'],
-                           values['password'],
-                           values['delay'])
+        store = WatchStore(values['state_db']) if values['state_db'] else None
+        shared = (SharedPageCache(values['shared_cache'], values['shared_ttl'])
+                  if values['shared_cache'] else None)
+        try:
+            seen = set()
+            events = list(read_event_urls(
+                    [values['event']] + values['other_events'], seen))
+            if values['events_file']:
+                #readline instead of the file iterator: no read-ahead, 
+                #the events are watched as soon as they are read
+                events = itertools.chain(
+                    events, 
+                    read_event_urls(iter(values['events_file'].readline, ''),
+                                    seen))
+            if values['daemon']:
+                run_daemon(manager, events, values, store, shared)
+            elif values['events_file'] or len(events) > 1:
+                watch_events(manager,
+                             events,
+                             values['delay'],
+                             values['stream'],
+                             values['max_delay'],
+                             values['budget'],
+                             values['probe_join'],
+                             store,
+                             shared,
+                             values['workers'])
+            else:
+                loop_to_join_event(manager,
+                                   values['event'],
+                                   values['delay'],
+                                   values['stream'],
+                                   values['max_delay'],
+                                   values['budget'],
+                                   values['probe_join'],
+                                   store,
+                                   shared)
+        finally:
+            #the session may have been renewed while polling
+            manager.save()
+            if store:
+                store.close()
+            if shared:
+                shared.close()
+    finally:
+        if parser_pool:
+            parser_pool.close()
+        if change_feed:
+            change_feed.close()
+        if values['metrics_file']:
+            metrics.dump(values['metrics_file'])
+        if recorder:
+            recorder.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,31 @@
+import coucheventjoiner
+
+def state(attendee_count, **fields):
+    """EventPageState of a logged in, not over event with 20 spots"""
+    values = dict(logged_in=True,
+                  over=False,
+                  attending=False,
+                  attendee_count=attendee_count,
+                  capacity=20,
+                  starts=None)
+    values.update(fields)
+    return coucheventjoiner.EventPageState(**values)
+
+def session_manager(*routes):
+    """
+    SessionManager of a session answered by a coucheventjoiner.FakeAdapter
+    following routes
+    """
+    (session, _) = coucheventjoiner.fake_session(routes)
+    return coucheventjoiner.SessionManager(session, 
+                                           'username', 
+                                           'password')
+
+class FakeClock(object):
+    """time.time and time.sleep of a clock that only moves when sleeping"""
+    def __init__(self):
+        self.now = 1000.0
+    def time(self):
+        return self.now
+    def sleep(self, seconds):
+        self.now += seconds
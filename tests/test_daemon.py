@@ -0,0 +1,134 @@
+import coucheventjoiner
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from mock import patch
+from helpers import session_manager
+from test_watchers import (FULL_EVENT, FULL_EVENT_URL, FREE_EVENT_URL, 
+                           BROKEN_EVENT, BROKEN_EVENT_URL)
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'control.sock')
+        self.daemon = coucheventjoiner.Daemon(session_manager(FULL_EVENT,
+                                                              BROKEN_EVENT), 
+                                              self.path, 
+                                              10)
+
+    def tearDown(self):
+        self.daemon.close()
+        shutil.rmtree(self.directory)
+
+    def test_add_and_remove(self):
+        self.assertIn('Watching', self.daemon.command('add ' + FULL_EVENT_URL))
+        self.assertIn(FULL_EVENT_URL, self.daemon.command('list'))
+        self.assertIn('already', self.daemon.command('add ' + FULL_EVENT_URL))
+        self.daemon.command('remove ' + FULL_EVENT_URL)
+        self.assertEqual('No event watched', self.daemon.command('list'))
+        self.assertNotIn(FULL_EVENT_URL, self.daemon.scheduler)
+
+    def test_invalid_commands(self):
+        for line in ['add http://example.com/n/events/1',
+                     'remove ' + FREE_EVENT_URL,
+                     'delay ' + FREE_EVENT_URL,
+                     'jump',
+                     '']:
+            self.assertTrue(self.daemon.command(line).startswith('error'), 
+                            line)
+
+    def test_wrong_number_of_arguments(self):
+        for line in ['delay ' + FULL_EVENT_URL, 'list now', 'add']:
+            self.assertTrue(self.daemon.command(line).startswith(
+                    'error: wrong number of arguments'), line)
+
+    def test_handler_error_not_hidden(self):
+        def broken_status(daemon):
+            return len(None)
+        with patch.object(coucheventjoiner.Daemon, 'status', broken_status):
+            with self.assertRaises(TypeError):
+                self.daemon.command('list')
+
+    def test_delay(self):
+        self.daemon.command('add ' + FULL_EVENT_URL)
+        self.assertTrue(
+            self.daemon.command('delay {0} 5'.format(FULL_EVENT_URL))
+            .startswith('error'))
+        self.daemon.scheduler.reschedule(FULL_EVENT_URL, time.time() + 300)
+        self.daemon.command('delay {0} 20'.format(FULL_EVENT_URL))
+        self.assertEqual(20, self.daemon.watches[FULL_EVENT_URL].delay.delay)
+        self.assertLessEqual(self.daemon.scheduler.due(FULL_EVENT_URL), 
+                             time.time() + 20)
+
+    def test_socket(self):
+        thread = threading.Thread(target=self.daemon.run)
+        thread.start()
+        try:
+            coucheventjoiner.send_command('add ' + FULL_EVENT_URL, self.path)
+            for _ in range(50):
+                status = coucheventjoiner.send_command('list', self.path)
+                if 'Event full' in status:
+                    break
+                time.sleep(0.02)
+            self.assertIn('Event full', status)
+        finally:
+            coucheventjoiner.send_command('stop', self.path)
+            thread.join()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_unparsable_page_keeps_daemon_running(self):
+        thread = threading.Thread(target=self.daemon.run)
+        thread.start()
+        try:
+            for event in (BROKEN_EVENT_URL, FULL_EVENT_URL):
+                coucheventjoiner.send_command('add ' + event, self.path)
+            for _ in range(50):
+                status = coucheventjoiner.send_command('list', self.path)
+                if 'Event full' in status and "determine" in status:
+                    break
+                time.sleep(0.02)
+            self.assertIn('Event full', status)
+            self.assertIn(BROKEN_EVENT_URL + ' next poll', status)
+            self.assertTrue(thread.is_alive())
+        finally:
+            coucheventjoiner.send_command('stop', self.path)
+            thread.join()
+
+    def test_send_events(self):
+        events = iter([FULL_EVENT_URL])
+        thread = threading.Thread(target=self.daemon.run)
+        thread.start()
+        try:
+            coucheventjoiner._send_events(events, self.path)
+            self.assertIn(FULL_EVENT_URL, self.daemon.watches)
+        finally:
+            coucheventjoiner.send_command('stop', self.path)
+            thread.join()
+        #no daemon any more: nothing sent, no error
+        coucheventjoiner._send_events(iter([FREE_EVENT_URL]), self.path)
+
+    def test_one_daemon_per_socket(self):
+        self.assertRaises(socket.error, 
+                          coucheventjoiner.Daemon, 
+                          session_manager(), self.path, 10)
+
+    def test_stale_socket_replaced(self):
+        self.daemon.close()
+        open(self.path, 'w').close()
+        self.assertRaises(socket.error, 
+                          coucheventjoiner.Daemon, 
+                          session_manager(), self.path, 10)
+        os.remove(self.path)
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self.daemon = coucheventjoiner.Daemon(session_manager(), self.path, 10)
+        self.assertEqual('No event watched', self.daemon.command('list'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import coucheventjoiner
+import datetime
+import json
+import unittest
+from StringIO import StringIO
+from mock import patch
+from helpers import state, session_manager
+
+FULL_EVENT_URL = 'https://www.couchsurfing.org/n/events/full'
+
+class TestStateChanges(unittest.TestCase):
+
+    def test_unchanged(self):
+        self.assertEqual([], coucheventjoiner.state_changes(state(20),
+                                                            state(20)))
+
+    def test_first_state(self):
+        self.assertEqual(['seen'], coucheventjoiner.state_changes(None,
+                                                                  state(20)))
+
+    def test_changes(self):
+        self.assertEqual(['attendees', 'over', 'logged_out'],
+                         coucheventjoiner.state_changes(
+                state(20), state(19, over=True, logged_in=False)))
+        self.assertEqual(['joined', 'attendees', 'attending'],
+                         coucheventjoiner.state_changes(
+                state(19), state(20, attending=True), joined=True))
+
+class TestChangeFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = StringIO()
+        self.feed = coucheventjoiner.ChangeFeed(self.sink, flush_interval=60)
+
+    def tearDown(self):
+        self.feed.close()
+
+    def lines(self):
+        self.feed.flush()
+        return [json.loads(line) for line in self.sink.getvalue().splitlines()]
+
+    def test_record(self):
+        starts = datetime.datetime(2014, 3, 23, 11, 30)
+        self.feed.record(FULL_EVENT_URL, None, state(20, starts=starts))
+        self.feed.record(FULL_EVENT_URL, state(20), state(20))
+        self.feed.record(FULL_EVENT_URL, state(20), state(19))
+        lines = self.lines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual(['seen'], lines[0]['changes'])
+        self.assertEqual('2014-03-23 11:30:00', lines[0]['starts'])
+        self.assertEqual(['attendees'], lines[1]['changes'])
+        self.assertEqual(19, lines[1]['attendee_count'])
+        self.assertFalse(lines[1]['joined'])
+
+    def test_quiet_event_writes_nothing(self):
+        page = open('event_logged_full_notjoined.html').read()
+        manager = session_manager(('GET', FULL_EVENT_URL, {'content': page}))
+        watch = coucheventjoiner.EventWatch(manager,
+                                            FULL_EVENT_URL,
+                                            coucheventjoiner.FixedDelay(10))
+        with patch.object(coucheventjoiner, 'change_feed', self.feed):
+            for _ in range(3):
+                watch.poll()
+        lines = self.lines()
+        self.assertEqual(1, len(lines))
+        self.assertEqual(['seen'], lines[0]['changes'])
+        self.assertEqual(FULL_EVENT_URL, lines[0]['event'])
+
+if __name__ == '__main__':
+    unittest.main()
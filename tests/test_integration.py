@@ -10,6 +10,7 @@ from httmock import HTTMock, urlmatch
 class TestIntegration(unittest.TestCase):
     
     @patch('sys.argv', [test_parse_args.APP_NAME, 
+                        '--no-session-store',
                         test_parse_args.EVENT_URL,
                         'username',
                         'password'
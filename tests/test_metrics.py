@@ -0,0 +1,79 @@
+import coucheventjoiner
+import test_watchers
+import json
+import urllib2
+import unittest
+from helpers import session_manager
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = coucheventjoiner.Metrics()
+
+    def test_counter(self):
+        self.metrics.inc('polls_total', event='a', result='retry')
+        self.metrics.inc('polls_total', event='a', result='retry')
+        self.metrics.inc('polls_total', event='b', result='ok')
+        counters = self.metrics.to_dict()['counters']
+        self.assertEqual([2, 1], [counter['value'] for counter in counters])
+        self.assertEqual({'event': 'a', 'result': 'retry'}, 
+                         counters[0]['labels'])
+
+    def test_histogram(self):
+        self.metrics.observe('poll_seconds', 0.003)
+        self.metrics.observe('poll_seconds', 20)
+        [histogram] = self.metrics.to_dict()['histograms']
+        self.assertEqual(2, histogram['count'])
+        self.assertAlmostEqual(20.003, histogram['sum'])
+        self.assertEqual([0.005, 1], histogram['buckets'][2])
+        self.assertEqual(1, histogram['buckets'][-1][1])
+
+    def test_prometheus(self):
+        self.metrics.inc('polls_total', event='say "hi"', result='ok')
+        self.metrics.observe('poll_seconds', 0.003, event='a')
+        text = self.metrics.to_prometheus()
+        self.assertIn('# TYPE coucheventjoiner_polls_total counter\n', text)
+        self.assertIn('coucheventjoiner_polls_total{event="say \\"hi\\"",'
+                      'result="ok"} 1\n', text)
+        self.assertIn('coucheventjoiner_poll_seconds_bucket{event="a",'
+                      'le="+Inf"} 1\n', text)
+        self.assertIn('coucheventjoiner_poll_seconds_count{event="a"} 1\n', 
+                      text)
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        coucheventjoiner.metrics.reset()
+
+    def test_poll(self):
+        watch = coucheventjoiner.EventWatch(
+            session_manager(test_watchers.FULL_EVENT),
+            test_watchers.FULL_EVENT_URL,
+            coucheventjoiner.FixedDelay(10))
+        watch.poll()
+        watch.poll()
+        values = coucheventjoiner.metrics.to_dict()
+        counters = dict((counter['name'], counter['value']) 
+                        for counter in values['counters'])
+        self.assertEqual(2, counters['polls_total'])
+        self.assertEqual(1, counters['page_unchanged_total'])
+        histograms = dict((histogram['name'], histogram['count']) 
+                          for histogram in values['histograms'])
+        self.assertEqual(1, histograms['page_parse_seconds'])
+        self.assertEqual(2, histograms['page_fetch_seconds'])
+
+    def test_endpoint(self):
+        coucheventjoiner.metrics.inc('polls_total', event='a', result='ok')
+        server = coucheventjoiner.serve_metrics(0)
+        try:
+            url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+            text = urllib2.urlopen(url + '/metrics').read()
+            values = json.load(urllib2.urlopen(url + '/metrics.json'))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('coucheventjoiner_polls_total', text)
+        self.assertEqual(1, values['counters'][0]['value'])
+
+if __name__ == '__main__':
+    unittest.main()
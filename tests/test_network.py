@@ -2,6 +2,15 @@ import coucheventjoiner
 import requests
 from httmock import HTTMock, all_requests, urlmatch
 import unittest
+import os
+import stat
+import shutil
+import tempfile
+import threading
+import time
+from mock import patch
+
+EVENT_URL = 'https://www.couchsurfing.org/n/events/eventname'
 
 @urlmatch(netloc=r'(.*\.)?couchsurfing\.org$', path='^/n/auth/?')
 def login_ok(url, request):
@@ -40,8 +49,204 @@ class TestNetwork(unittest.TestCase):
         with HTTMock(event_full):
             self.assertFalse(coucheventjoiner.join_event(requests.Session(),
                                         'https://www.couchsurfing.org/n/events/eventname'))
-            
-            
+
+    def test_fake_transport(self):
+        page = open('event_logged_freespot_notjoined.html').read()
+        (session, fake) = coucheventjoiner.fake_session([
+                ('POST', r'https://[^/]+/n/auth', {'status_code': 200}),
+                ('GET', r'https://[^/]+/n/events/', {'content': page}),
+                ('POST', r'https://[^/]+/n/events/[^/]+/join', {})])
+        coucheventjoiner.login('username', 'password', session)
+        for stream in (False, True):
+            (state, (result, _)) = coucheventjoiner.get_event_page(
+                session, EVENT_URL, stream=stream)
+            self.assertEqual(coucheventjoiner.Result.ok, result)
+            self.assertTrue(state.logged_in)
+        self.assertTrue(coucheventjoiner.join_event(session, EVENT_URL))
+        self.assertEqual(['POST', 'GET', 'GET', 'POST'], 
+                         [request.method for request in fake.sent])
+        self.assertEqual(EVENT_URL + '/join', fake.sent[-1].url)
+
+    def test_fake_transport_unrouted(self):
+        (session, fake) = coucheventjoiner.fake_session()
+        fake.route('POST', r'.*/join', 
+                   lambda request: {'content': '{"error":"This event is full."}'})
+        self.assertFalse(coucheventjoiner.join_event(session, EVENT_URL))
+        with self.assertRaises(coucheventjoiner.LoginException):
+            coucheventjoiner.login('username', 'password', session)
+
+    def test_pooled_session(self):
+        session = coucheventjoiner.make_session(pool_size=32)
+        adapter = session.get_adapter(EVENT_URL)
+        self.assertEqual(32, adapter._pool_maxsize)
+        self.assertTrue(adapter._pool_block)
+        self.assertEqual(0, adapter.max_retries.total)
+
+    def test_throttled_session(self):
+        bucket = coucheventjoiner.TokenBucket(1)
+        (session, _) = coucheventjoiner.fake_session([
+                ('POST', r'.*/join', {})])
+        with patch.object(bucket, 'acquire') as acquire:
+            session = coucheventjoiner.throttle(session, bucket)
+            coucheventjoiner.join_event(session, EVENT_URL)
+            coucheventjoiner.join_event(session, EVENT_URL)
+        self.assertEqual(2, acquire.call_count)
+
+    def test_conditional_get(self):
+        def event_page(request):
+            if request.headers.get('If-None-Match') == '"v1"':
+                return {'status_code': 304}
+            return {'headers': {'ETag': '"v1"'},
+                    'content': open('event_logged_full_notjoined.html').read()}
+        (session, fake) = coucheventjoiner.fake_session([
+                ('GET', EVENT_URL, event_page)])
+        cache = coucheventjoiner.PageCache()
+        (first, _) = coucheventjoiner.get_event_page(session, EVENT_URL, cache)
+        (second, (result, _)) = coucheventjoiner.get_event_page(session,
+                                                                EVENT_URL, 
+                                                                cache)
+        self.assertNotIn('If-None-Match', fake.sent[0].headers)
+        self.assertEqual('"v1"', fake.sent[1].headers['If-None-Match'])
+        self.assertEqual(coucheventjoiner.Result.ok, result)
+        self.assertIs(first, second)
+
+    def test_same_page_not_parsed_again(self):
+        (session, _) = coucheventjoiner.fake_session([
+                ('GET', EVENT_URL, 
+                 {'content': open('event_logged_full_notjoined.html').read()})])
+        cache = coucheventjoiner.PageCache()
+        with patch('coucheventjoiner.extract_event_state', 
+                   wraps=coucheventjoiner.extract_event_state) as extract:
+            for _ in range(3):
+                (state, _) = coucheventjoiner.get_event_page(session, 
+                                                             EVENT_URL, 
+                                                             cache)
+        self.assertEqual(1, extract.call_count)
+        self.assertTrue(state.is_full())
+
+class TestHotJoin(unittest.TestCase):
+
+    def test_fire(self):
+        (session, fake) = coucheventjoiner.fake_session([
+                ('POST', r'.*/join', {})])
+        joiner = coucheventjoiner.HotJoin(session, EVENT_URL)
+        prepared = joiner.prepare()
+        session.cookies.set('_couchsurfing_session', 'renewed', 
+                            domain='www.couchsurfing.org')
+        self.assertTrue(joiner.fire(time.time()))
+        self.assertTrue(joiner.fire())
+        self.assertIs(prepared, joiner.prepare())
+        self.assertEqual(EVENT_URL + '/join', fake.sent[0].url)
+        self.assertIn('renewed', fake.sent[0].headers['Cookie'])
+        self.assertEqual(1, len(joiner.latencies))
+
+    def test_fire_sends_current_cookie(self):
+        (session, fake) = coucheventjoiner.fake_session([
+                ('POST', r'.*/join', {})])
+        session.cookies.set('sess', 'OLD', domain='www.couchsurfing.org')
+        joiner = coucheventjoiner.HotJoin(session, EVENT_URL)
+        joiner.prepare()
+        joiner.fire()
+        #relogin
+        session.cookies.set('sess', 'NEW', domain='www.couchsurfing.org')
+        joiner.fire()
+        self.assertEqual(['sess=OLD', 'sess=NEW'], 
+                         [request.headers.get('Cookie') 
+                          for request in fake.sent])
+
+    def test_prepared_once_per_session(self):
+        (session, fake) = coucheventjoiner.fake_session([
+                ('POST', r'.*/join', {})])
+        other_url = 'https://www.couchsurfing.org/n/events/other'
+        joiner = coucheventjoiner.HotJoin(session, EVENT_URL)
+        other = coucheventjoiner.HotJoin(session, other_url)
+        self.assertIs(joiner.prepare(), other.prepare())
+        self.assertIsNot(joiner.prepare(), 
+                         coucheventjoiner.HotJoin(requests.Session(), 
+                                                  EVENT_URL).prepare())
+        other.fire()
+        joiner.fire()
+        self.assertEqual([other_url + '/join', EVENT_URL + '/join'], 
+                         [request.url for request in fake.sent])
+
+    def test_fire_full(self):
+        (session, _) = coucheventjoiner.fake_session([
+                ('POST', r'.*/join', 
+                 {'content': '{"error":"This event is full."}'})])
+        joiner = coucheventjoiner.HotJoin(session, EVENT_URL)
+        self.assertFalse(joiner.fire())
+
+class TestSessionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.logins = []
+
+    def manager(self, status_code, delay=0):
+        def login_page(request):
+            self.logins.append(request)
+            time.sleep(delay)
+            return {'status_code': status_code}
+        (session, _) = coucheventjoiner.fake_session([
+                ('POST', r'.*/n/auth', login_page)])
+        return coucheventjoiner.SessionManager(session, 
+                                               'username', 
+                                               'password')
+
+    def test_relogin_once_per_generation(self):
+        manager = self.manager(200)
+        manager.relogin(0)
+        manager.relogin(0)
+        self.assertEqual(1, len(self.logins))
+        self.assertEqual(1, manager.generation)
+        self.assertEqual(1, manager.logins_last_hour())
+
+    def test_concurrent_relogin_single_flight(self):
+        manager = self.manager(200, delay=0.05)
+        threads = [threading.Thread(target=manager.relogin, args=(0,))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(self.logins))
+
+    def test_backoff_after_failure(self):
+        manager = self.manager(406)
+        with self.assertRaises(coucheventjoiner.LoginException):
+            manager.relogin(0)
+        with self.assertRaises(coucheventjoiner.LoginException):
+            manager.relogin(0)
+        self.assertEqual(1, len(self.logins))
+        self.assertEqual(0, manager.generation)
+
+class TestSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        session = requests.Session()
+        session.cookies.set('_couchsurfing_session', 'abc', 
+                            domain='www.couchsurfing.org')
+        coucheventjoiner.save_cookies(session, 'user/name', self.directory)
+        path = coucheventjoiner.session_file('user/name', self.directory)
+        self.assertEqual(self.directory, os.path.dirname(path))
+        self.assertEqual(0600, stat.S_IMODE(os.stat(path).st_mode))
+
+        restored = requests.Session()
+        self.assertTrue(coucheventjoiner.load_cookies(restored, 
+                                                      'user/name', 
+                                                      self.directory))
+        self.assertEqual('abc', restored.cookies['_couchsurfing_session'])
+
+    def test_load_missing(self):
+        self.assertFalse(coucheventjoiner.load_cookies(requests.Session(),
+                                                       'username',
+                                                       self.directory))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -35,6 +35,25 @@ class TestParseArgs(unittest.TestCase):
                     'event': EVENT_URL,
                     'username': 'username',
                     'password': 'password',
+                    'other_events': [],
+                    'events_file': None,
+                    'stream': False,
+                    'max_delay': None,
+                    'budget': None,
+                    'max_rate': None,
+                    'session_store': True,
+                    'probe_join': None,
+                    'workers': 1,
+                    'parse_processes': None,
+                    'feed': None,
+                    'record': None,
+                    'daemon': None,
+                    'state_db': None,
+                    'shared_cache': None,
+                    'shared_ttl': coucheventjoiner.DEFAULT_SHARED_TTL,
+                    'metrics_port': None,
+                    'metrics_file': None,
+                    'metrics_interval': coucheventjoiner.DEFAULT_METRICS_INTERVAL,
         }
         args = coucheventjoiner.get_user_values()
         self.assertEqual(expected, args)
@@ -46,6 +65,25 @@ class TestParseArgs(unittest.TestCase):
                     'event': EVENT_URL,
                     'username': 'username',
                     'password': 'password',
+                    'other_events': [],
+                    'events_file': None,
+                    'stream': False,
+                    'max_delay': None,
+                    'budget': None,
+                    'max_rate': None,
+                    'session_store': True,
+                    'probe_join': None,
+                    'workers': 1,
+                    'parse_processes': None,
+                    'feed': None,
+                    'record': None,
+                    'daemon': None,
+                    'state_db': None,
+                    'shared_cache': None,
+                    'shared_ttl': coucheventjoiner.DEFAULT_SHARED_TTL,
+                    'metrics_port': None,
+                    'metrics_file': None,
+                    'metrics_interval': coucheventjoiner.DEFAULT_METRICS_INTERVAL,
         }
         args = coucheventjoiner.get_user_values()
         self.assertEqual(expected, args)
@@ -67,6 +105,28 @@ class TestParseArgs(unittest.TestCase):
         with self.assertRaises(SystemExit):
            coucheventjoiner.get_user_values()
 
+    @patch('sys.argv', [APP_NAME,
+                        '-m',
+                        str(coucheventjoiner.DEFAULT_RETRY_DELAY - 1),
+                        EVENT_URL,
+                        'username',
+                        'password'
+                    ])
+    def test_max_delay_smaller_than_delay(self):
+        with self.assertRaises(SystemExit):
+           coucheventjoiner.get_user_values()
+
+    @patch('sys.argv', [APP_NAME,
+                        '-b',
+                        '60',
+                        EVENT_URL,
+                        'username',
+                        'password'
+                    ])
+    def test_budget_without_max_delay(self):
+        with self.assertRaises(SystemExit):
+           coucheventjoiner.get_user_values()
+
     @patch('sys.argv', [APP_NAME, 
                         'https://www.NOTcouchsurfing.org./n/events/eventname', 
                         'username',
@@ -113,6 +173,71 @@ class TestParseArgs(unittest.TestCase):
         self.assertEqual('https://www.couchsurfing.org/n/events/eventname',
                          args['event'])
 
+    @patch('sys.argv', [APP_NAME,
+                        '-e',
+                        'http://www.couchsurfing.org/n/events/other',
+                        '--event',
+                        'https://www.couchsurfing.org/n/events/another',
+                        EVENT_URL,
+                        'username',
+                        'password'
+                        ])
+    def test_other_events(self):
+        args = coucheventjoiner.get_user_values()
+        self.assertEqual(EVENT_URL, args['event'])
+        self.assertEqual(['https://www.couchsurfing.org/n/events/other',
+                          'https://www.couchsurfing.org/n/events/another'],
+                         args['other_events'])
+
+    @patch('sys.argv', [APP_NAME,
+                        '-e',
+                        'https://www.couchsurfing.org/n/events/',
+                        EVENT_URL,
+                        'username',
+                        'password'
+                        ])
+    def test_other_event_invalid(self):
+        with self.assertRaises(SystemExit):
+            coucheventjoiner.get_user_values()
+
+    @patch('sys.argv', [APP_NAME, '-f', '-', EVENT_URL, 'username', 'password'])
+    def test_events_file_stdin(self):
+        args = coucheventjoiner.get_user_values()
+        self.assertIs(sys.stdin, args['events_file'])
+
+    @patch('sys.argv', [APP_NAME, 
+                        '-f', 
+                        '/nonexistent/events.txt', 
+                        EVENT_URL, 
+                        'username', 
+                        'password'])
+    def test_events_file_missing(self):
+        with self.assertRaises(SystemExit):
+            coucheventjoiner.get_user_values()
+
+    @patch('sys.stderr')
+    def test_read_event_urls(self, stderr):
+        lines = ['# events of the week\n',
+                 'http://www.couchsurfing.org/n/events/one\n',
+                 '\n',
+                 'https://www.couchsurfing.org/n/places/paris\n',
+                 '  https://www.couchsurfing.org/n/events/two?ref=mail  \n',
+                 'https://www.couchsurfing.org/n/events/one#top\n',
+                 EVENT_URL]
+        urls = list(coucheventjoiner.read_event_urls(lines, set([EVENT_URL])))
+        self.assertEqual(['https://www.couchsurfing.org/n/events/one',
+                          'https://www.couchsurfing.org/n/events/two'],
+                         urls)
+        stderr.write.assert_called_once()
+        self.assertIn('line 4', stderr.write.call_args[0][0])
+
+    def test_read_event_urls_is_lazy(self):
+        def lines():
+            yield EVENT_URL
+            raise AssertionError('read too far')
+        urls = coucheventjoiner.read_event_urls(lines())
+        self.assertEqual(EVENT_URL, next(urls))
+
     @unittest.skip('fails if no protocol. See http://docs.python.org/2/'
                    'library/urlparse.html#urlparse.urlparse')
     @patch('sys.argv', [APP_NAME,
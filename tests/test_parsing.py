@@ -1,7 +1,10 @@
 import coucheventjoiner
+import os
 import unittest
-from mock import Mock
+from mock import Mock, patch
 import lxml.html
+import datetime
+import threading
 
 #There are files representing event page in various states
 class TestParsing(unittest.TestCase):
@@ -38,5 +41,156 @@ class TestParsing(unittest.TestCase):
     def test_not_full(self):
         self.assertFalse(coucheventjoiner.is_event_full(self.event_ok))
 
+    def test_over_capacity(self):
+        #the organizer lowered the limit or let more people in: still full
+        page = lxml.html.fromstring(
+            open('event_logged_full_notjoined.html').read().replace(
+                "<span class='attendee_count'>20</span>",
+                "<span class='attendee_count'>21</span>"))
+        self.assertTrue(coucheventjoiner.is_event_full(page))
+        state = coucheventjoiner.extract_event_state(page)
+        self.assertEqual((21, 20), (state.attendee_count, state.capacity))
+        self.assertTrue(state.is_full())
+
     def test_no_spot_limit(self):
         self.assertFalse(coucheventjoiner.is_event_full(self.event_unlogged))
+
+    def test_state_free_spot(self):
+        state = coucheventjoiner.extract_event_state(self.event_ok)
+        self.assertTrue(state.logged_in)
+        self.assertFalse(state.over)
+        self.assertFalse(state.attending)
+        self.assertFalse(state.is_full())
+        self.assertLess(state.attendee_count, state.capacity)
+
+    def test_state_full(self):
+        state = coucheventjoiner.extract_event_state(self.event_full)
+        self.assertEqual((20, 20), (state.attendee_count, state.capacity))
+        self.assertTrue(state.is_full())
+
+    def test_state_unlogged_no_spot_limit(self):
+        state = coucheventjoiner.extract_event_state(self.event_unlogged)
+        self.assertFalse(state.logged_in)
+        self.assertTrue(state.over)
+        self.assertIsNone(state.capacity)
+        self.assertFalse(state.is_full())
+
+    def test_state_attending_over(self):
+        state = coucheventjoiner.extract_event_state(self.event_attending)
+        self.assertTrue(state.attending)
+        self.assertTrue(state.over)
+
+    def test_state_no_counter(self):
+        state = coucheventjoiner.extract_event_state(
+            lxml.html.fromstring('<html><body><div id="sidebar"></div>'
+                                 '</body></html>'))
+        self.assertIsNone(state.attendee_count)
+        with self.assertRaises(coucheventjoiner.ParsingError):
+            state.is_full()
+
+    def test_stream_stops_after_counter(self):
+        content = open('event_logged_full_notjoined.html').read()
+        chunks = [content[i:i + 4096] for i in range(0, len(content), 4096)]
+        consumed = []
+        def read_chunks():
+            for chunk in chunks:
+                consumed.append(chunk)
+                yield chunk
+        state = coucheventjoiner.parse_event_page_stream(read_chunks())
+        self.assertEqual(coucheventjoiner.extract_event_state(self.event_full),
+                         state)
+        self.assertLess(len(consumed), len(chunks))
+
+    def test_stream_same_state(self):
+        for (name, tree) in [('event_logged_freespot_notjoined.html', 
+                              self.event_ok),
+                             ('event_unlogged_past_nospotlimit.html',
+                              self.event_unlogged),
+                             ('event_attending_over.html',
+                              self.event_attending)]:
+            state = coucheventjoiner.parse_event_page_stream(
+                iter([open(name).read()]))
+            self.assertEqual(coucheventjoiner.extract_event_state(tree), state)
+
+    def test_event_start(self):
+        state = coucheventjoiner.extract_event_state(self.event_full)
+        self.assertEqual((3, 23, 11, 30), (state.starts.month,
+                                           state.starts.day,
+                                           state.starts.hour,
+                                           state.starts.minute))
+
+    def test_event_start_closest_year(self):
+        sidebar = self.event_unlogged.get_element_by_id('sidebar')
+        start = coucheventjoiner._event_start(sidebar, 
+                                              datetime.datetime(2014, 9, 1))
+        self.assertEqual(datetime.datetime(2014, 3, 20, 19, 0), start)
+
+class TestParserPool(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = coucheventjoiner.ParserPool(2, max_pending=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_same_state(self):
+        for name in ['event_logged_freespot_notjoined.html',
+                     'event_logged_full_notjoined.html',
+                     'event_unlogged_past_nospotlimit.html',
+                     'event_attending_over.html']:
+            content = open(name).read()
+            self.assertEqual(coucheventjoiner.extract_event_state(
+                    lxml.html.fromstring(content)), 
+                             self.pool.parse(content))
+
+    def test_blocks_when_full(self):
+        content = open('event_logged_full_notjoined.html').read()
+        states = []
+        self.pool._pending.acquire()
+        parsing = threading.Thread(
+            target=lambda: states.append(self.pool.parse(content)))
+        parsing.start()
+        parsing.join(0.2)
+        self.assertTrue(parsing.is_alive())
+        self.pool._pending.release()
+        parsing.join()
+        self.assertTrue(states[0].is_full())
+
+    @patch('coucheventjoiner.PARSE_TIMEOUT', 0.05)
+    def test_lost_page_polled_again(self):
+        #what the pool gives back when the process parsing the page died
+        lost = Mock()
+        lost.ready.return_value = False
+        (session, _) = coucheventjoiner.fake_session([
+                ('GET', '.*', {'content': '<html></html>'})])
+        with patch.object(self.pool._pool, 'apply_async', return_value=lost), \
+                patch.object(coucheventjoiner, 'parser_pool', self.pool):
+            (state, (result, msg)) = coucheventjoiner.get_event_page(
+                session, 'https://www.couchsurfing.org/n/events/lost')
+        self.assertIsNone(state)
+        self.assertEqual(coucheventjoiner.Result.retry, result)
+        self.assertIn('0.05s', msg)
+        #the page doesn't keep its place in the pool
+        self.assertTrue(self.pool._pending.acquire(False))
+        self.pool._pending.release()
+
+    @patch('sys.argv', ['coucheventjoiner.py', 
+                        '--parse-processes', '2',
+                        '--feed', os.devnull,
+                        '--no-session-store',
+                        'https://www.couchsurfing.org/n/events/eventname',
+                        'username',
+                        'password'])
+    def test_closed_when_login_fails(self):
+        with patch.object(coucheventjoiner, 'ParserPool') as pool, \
+                patch.object(coucheventjoiner, 'ChangeFeed') as feed, \
+                patch.object(coucheventjoiner, 'parser_pool', None), \
+                patch.object(coucheventjoiner, 'change_feed', None), \
+                patch.object(coucheventjoiner.SessionManager, 'login',
+                             side_effect=coucheventjoiner.LoginException(
+                        'Invalid username/password')):
+            coucheventjoiner.main()
+        pool.return_value.close.assert_called_once_with()
+        feed.return_value.close.assert_called_once_with()
@@ -0,0 +1,82 @@
+import coucheventjoiner
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from helpers import FakeClock
+
+EVENT_URL = 'https://www.couchsurfing.org/n/events/eventname'
+
+class TestRecordReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traffic.json.gz')
+        self.pages = [open('event_logged_full_notjoined.html').read(),
+                      open('event_logged_freespot_notjoined.html').read()]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, clock=None):
+        pages = iter(self.pages)
+        (session, _) = coucheventjoiner.fake_session([
+                ('POST', r'.*/n/auth', {'headers': {'Set-Cookie': 'id=1'}}),
+                ('GET', EVENT_URL, lambda request: {'content': next(pages)}),
+                ('POST', r'.*/join', {'error': 'connection reset'})])
+        recorder = coucheventjoiner.record_session(session, self.path)
+        coucheventjoiner.login('username', 'secret', session)
+        for _ in self.pages:
+            session.get(EVENT_URL)
+            if clock:
+                clock.sleep(60)
+        self.assertFalse(coucheventjoiner.join_event(session, EVENT_URL))
+        recorder.close()
+
+    def replay(self, speed):
+        (session, _) = coucheventjoiner.fake_session()
+        adapter = coucheventjoiner.ReplayAdapter(self.path, speed)
+        session.mount('https://', adapter)
+        return session
+
+    def test_recording(self):
+        self.record()
+        records = list(coucheventjoiner.read_recording(self.path))
+        self.assertEqual(['POST', 'GET', 'GET', 'POST'],
+                         [record['method'] for record in records])
+        self.assertEqual({}, records[0]['headers'])
+        self.assertNotIn('secret', str(records))
+        self.assertEqual('connection reset', records[-1]['error'])
+
+    def test_replay_in_order(self):
+        self.record()
+        session = self.replay(0)
+        self.assertEqual(self.pages + [self.pages[-1]],
+                         [session.get(EVENT_URL).content for _ in range(3)])
+        self.assertFalse(coucheventjoiner.join_event(session, EVENT_URL))
+        self.assertEqual(404, session.get(EVENT_URL + '/other').status_code)
+
+    def test_replay_timeline(self):
+        clock = FakeClock()
+        with patch('time.time', clock.time), patch('time.sleep', clock.sleep):
+            self.record(clock)
+            session = self.replay(10)
+            contents = []
+            for _ in range(4):
+                contents.append(session.get(EVENT_URL).content)
+                clock.sleep(3)
+        #the page changed 60 s after the start of the recording: 6 s here
+        self.assertEqual([self.pages[0]] * 2 + [self.pages[1]] * 2, contents)
+
+    def test_truncated_recording(self):
+        self.record()
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(content[:-8])
+        self.assertEqual(4, len(list(
+                    coucheventjoiner.read_recording(self.path))))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import coucheventjoiner
+import unittest
+from helpers import state, session_manager
+
+EVENT_URL = 'https://www.couchsurfing.org/n/events/rules'
+
+def engine():
+    Rule = coucheventjoiner.Rule
+    Result = coucheventjoiner.Result
+    return coucheventjoiner.RuleEngine([
+            Rule('never', lambda state: False, Result.retry, 'Never'),
+            Rule('event_full', 
+                 coucheventjoiner.EventPageState.is_full, 
+                 Result.retry, 
+                 'Event full'),
+            Rule('event_over', 
+                 lambda state: state.over, 
+                 Result.abandon, 
+                 'Event is over')])
+
+class TestRuleEngine(unittest.TestCase):
+
+    def test_terminal_rules_first(self):
+        rules = engine()
+        self.assertEqual(['event_over', 'never', 'event_full'],
+                         [rule.name for rule in rules.rules])
+        self.assertEqual((coucheventjoiner.Result.abandon, 'Event is over'),
+                         rules.evaluate(state(20, over=True)))
+
+    def test_matching_rules_move_up(self):
+        rules = engine()
+        for _ in range(rules.REORDER_EVERY):
+            self.assertEqual(coucheventjoiner.Result.retry,
+                             rules.evaluate(state(20))[0])
+        self.assertEqual(['event_over', 'event_full', 'never'],
+                         [rule['name'] for rule in rules.stats()])
+        self.assertEqual(1.0, rules.stats()[1]['hit_rate'])
+        self.assertEqual(0, rules.stats()[2]['hits'])
+
+    def test_one_evaluation_in_n_timed(self):
+        rules = engine()
+        for _ in range(rules.TIME_EVERY):
+            rules.evaluate(state(20))
+        self.assertEqual([rules.TIME_EVERY] * 3, 
+                         [rule['calls'] for rule in rules.stats()])
+        self.assertEqual([1] * 3, [rule.timed for rule in rules.rules])
+        self.assertIsNotNone(rules.stats()[0]['mean_seconds'])
+
+    def test_metrics(self):
+        coucheventjoiner.metrics.reset()
+        rules = engine()
+        for _ in range(rules.TIME_EVERY):
+            rules.evaluate(state(20))
+        values = coucheventjoiner.metrics.to_dict()
+        counters = dict(((counter['name'], counter['labels']['rule']), 
+                         counter['value']) 
+                        for counter in values['counters'])
+        self.assertEqual(rules.TIME_EVERY, 
+                         counters[('rule_calls_total', 'never')])
+        self.assertEqual(rules.TIME_EVERY, 
+                         counters[('rule_hits_total', 'event_full')])
+        self.assertNotIn(('rule_hits_total', 'never'), counters)
+        self.assertEqual(['rule_seconds'] * 3, 
+                         [histogram['name'] 
+                          for histogram in values['histograms']])
+
+    def test_free_event(self):
+        rules = engine()
+        self.assertEqual((coucheventjoiner.Result.ok, ''),
+                         rules.evaluate(state(19)))
+
+    def test_terminal_event_not_polled_again(self):
+        page = open('event_attending_over.html').read()
+        manager = session_manager(('GET', EVENT_URL, {'content': page}))
+        fake = manager.session.get_adapter(EVENT_URL)
+        cache = coucheventjoiner.PageCache()
+        results = [coucheventjoiner.poll_event(manager, EVENT_URL, cache) 
+                   for _ in range(3)]
+        self.assertEqual([results[0]] * 3, results)
+        self.assertEqual(coucheventjoiner.Result.abandon, results[0][0])
+        self.assertEqual(1, len(fake.sent))
+        #another watch of the event
+        coucheventjoiner.poll_event(manager, EVENT_URL, 
+                                    coucheventjoiner.PageCache())
+        self.assertEqual(2, len(fake.sent))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+import coucheventjoiner
+import datetime
+import threading
+import Queue
+import time
+import unittest
+from mock import patch
+from helpers import state, FakeClock
+
+NOW = datetime.datetime(2014, 3, 20, 12, 0)
+
+#no jitter
+@patch('random.uniform', lambda a, b: 1)
+class TestAdaptiveDelay(unittest.TestCase):
+
+    def test_backs_off_when_static(self):
+        delay = coucheventjoiner.AdaptiveDelay(10, 60)
+        delays = [delay.next_delay(state(20), NOW) for _ in range(6)]
+        self.assertEqual(sorted(delays), delays)
+        self.assertLess(delays[0], delays[-1])
+        self.assertEqual(60, delays[-1])
+
+    def test_churn_resets_delay(self):
+        delay = coucheventjoiner.AdaptiveDelay(10, 60)
+        for _ in range(6):
+            delay.next_delay(state(20), NOW)
+        self.assertEqual(10, delay.next_delay(state(19), NOW))
+
+    def test_event_about_to_start(self):
+        delay = coucheventjoiner.AdaptiveDelay(10, 600)
+        starts = NOW + datetime.timedelta(minutes=10)
+        for _ in range(10):
+            self.assertLessEqual(
+                delay.next_delay(state(20, starts=starts), NOW), 30)
+
+    def test_unknown_state(self):
+        delay = coucheventjoiner.AdaptiveDelay(10, 60)
+        self.assertEqual(15, delay.next_delay(None, NOW))
+
+    def test_budget(self):
+        budget = coucheventjoiner.RequestBudget(6)
+        delays = [coucheventjoiner.AdaptiveDelay(10, 60, budget) 
+                  for _ in range(3)]
+        self.assertEqual(30, delays[0].next_delay(state(20), NOW))
+        for delay in delays:
+            delay.close()
+        self.assertEqual(0, budget.watchers)
+
+class TestFixedDelay(unittest.TestCase):
+
+    def test_fixed(self):
+        delay = coucheventjoiner.make_delay(30)
+        self.assertEqual(30, delay.next_delay(state(20), NOW))
+        self.assertEqual(30, delay.next_delay(state(19), NOW))
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate(self):
+        clock = FakeClock()
+        with patch('time.time', clock.time), patch('time.sleep', clock.sleep):
+            bucket = coucheventjoiner.TokenBucket(2, burst=1)
+            start = clock.now
+            for _ in range(11):
+                bucket.acquire()
+            self.assertAlmostEqual(5, clock.now - start)
+
+    def test_burst(self):
+        clock = FakeClock()
+        with patch('time.time', clock.time), patch('time.sleep', clock.sleep):
+            bucket = coucheventjoiner.TokenBucket(1, burst=3)
+            start = clock.now
+            for _ in range(3):
+                bucket.acquire()
+            self.assertEqual(start, clock.now)
+            bucket.acquire()
+            self.assertAlmostEqual(1, clock.now - start)
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.polled = []
+
+    def watcher(self, name, delays):
+        for delay in delays:
+            self.polled.append(name)
+            yield delay
+
+    def test_due_order(self):
+        clock = FakeClock()
+        with patch('time.time', clock.time), patch('time.sleep', clock.sleep):
+            scheduler = coucheventjoiner.Scheduler()
+            scheduler.add('a', self.watcher('a', [30, 30]))
+            scheduler.add('b', self.watcher('b', [20, 20]))
+            scheduler.add('c', self.watcher('c', [10]), due=clock.now + 5)
+            scheduler.run()
+        self.assertEqual(['a', 'b', 'c', 'b', 'a'], self.polled)
+        self.assertEqual(0, len(scheduler))
+
+    def test_remove(self):
+        clock = FakeClock()
+        with patch('time.time', clock.time), patch('time.sleep', clock.sleep):
+            scheduler = coucheventjoiner.Scheduler()
+            scheduler.add('a', self.watcher('a', [10] * 5))
+            scheduler.add('b', self.watcher('b', [10] * 5))
+            scheduler.run_once()
+            scheduler.remove('a')
+            scheduler.run()
+        self.assertEqual(['a'] + ['b'] * 5, self.polled)
+        self.assertNotIn('a', scheduler)
+
+    def test_reschedule(self):
+        clock = FakeClock()
+        with patch('time.time', clock.time), patch('time.sleep', clock.sleep):
+            scheduler = coucheventjoiner.Scheduler()
+            scheduler.add('a', self.watcher('a', [10]), due=clock.now + 5)
+            scheduler.add('b', self.watcher('b', [10]), due=clock.now + 50)
+            scheduler.reschedule('b', clock.now + 1)
+            self.assertEqual(clock.now + 1, scheduler.next_due())
+            self.assertEqual(clock.now + 1, scheduler.due('b'))
+            scheduler.run()
+        self.assertEqual(['b', 'a'], self.polled)
+
+def pipe():
+    """
+    Returns:
+    (Queue.Queue, generator): the generator yields what is put in the queue
+        until None, blocking in between like a pipe left open
+    """
+    incoming = Queue.Queue()
+    return (incoming, iter(incoming.get, None))
+
+def polled_while_reading(test, scheduler, watcher):
+    (incoming, events) = pipe()
+    scheduler.add_from(events, lambda event: watcher(event))
+    incoming.put('a')
+    for _ in range(100):
+        if 'a' in test.polled:
+            break
+        scheduler.run_once()
+    #polled while the reader still waits for the next line
+    test.assertEqual(['a'], test.polled)
+    incoming.put('b')
+    incoming.put(None)
+    scheduler.run()
+    test.assertEqual(['a', 'b'], test.polled)
+    test.assertEqual(0, len(scheduler))
+
+class TestAddFrom(unittest.TestCase):
+
+    def setUp(self):
+        self.polled = []
+
+    def watcher(self, name):
+        self.polled.append(name)
+        yield 0
+
+    def test_scheduler(self):
+        polled_while_reading(self, 
+                             coucheventjoiner.Scheduler(), 
+                             self.watcher)
+
+    def test_concurrent_scheduler(self):
+        polled_while_reading(self, 
+                             coucheventjoiner.ConcurrentScheduler(2), 
+                             self.watcher)
+
+class TestConcurrentScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.polling = set()
+        self.polled = []
+        self.overlaps = 0
+
+    def watcher(self, name, polls, duration=0.05):
+        for _ in range(polls):
+            with self.lock:
+                self.overlaps += name in self.polling
+                self.polling.add(name)
+            time.sleep(duration)
+            with self.lock:
+                self.polling.discard(name)
+                self.polled.append(name)
+            yield 0
+
+    def test_polls_at_the_same_time(self):
+        scheduler = coucheventjoiner.ConcurrentScheduler(4)
+        for name in 'abcd':
+            scheduler.add(name, self.watcher(name, 2, 0.2))
+        start = time.time()
+        scheduler.run()
+        #each round of 4 polls takes one poll time instead of four
+        self.assertLess(time.time() - start, 1.2)
+        self.assertEqual(sorted('aabbccdd'), sorted(self.polled))
+        self.assertEqual(0, len(scheduler))
+
+    def test_event_polled_by_one_worker(self):
+        scheduler = coucheventjoiner.ConcurrentScheduler(4)
+        scheduler.add('a', self.watcher('a', 5))
+        scheduler.add('b', self.watcher('b', 5))
+        scheduler.reschedule('a', time.time())
+        scheduler.run()
+        self.assertEqual(0, self.overlaps)
+        self.assertEqual(5, self.polled.count('a'))
+
+    def test_remove_while_polled(self):
+        scheduler = coucheventjoiner.ConcurrentScheduler(2)
+        scheduler.add('a', self.watcher('a', 5, 0.2))
+        scheduler.add('b', self.watcher('b', 2))
+        while 'a' not in self.polling:
+            scheduler.run_once()
+        scheduler.remove('a')
+        self.assertNotIn('a', scheduler)
+        scheduler.run()
+        self.assertEqual(1, self.polled.count('a'))
+        self.assertEqual(2, self.polled.count('b'))
+
+    def test_error_raised_in_loop(self):
+        def failing():
+            raise ValueError('poll failed')
+            yield
+        scheduler = coucheventjoiner.ConcurrentScheduler(2)
+        scheduler.add('a', failing())
+        with self.assertRaises(ValueError):
+            scheduler.run()
+        self.assertNotIn('a', scheduler)
+
+if __name__ == '__main__':
+    unittest.main()
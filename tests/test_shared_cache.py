@@ -0,0 +1,76 @@
+import coucheventjoiner
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from mock import patch
+from helpers import state, session_manager
+from test_watchers import FULL_EVENT_URL
+
+STARTS = datetime.datetime(2014, 9, 1, 19, 30)
+
+class TestSharedPageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'pages.db')
+        #two instances of the program
+        self.first = coucheventjoiner.SharedPageCache(self.path, ttl=10)
+        self.second = coucheventjoiner.SharedPageCache(self.path, ttl=10)
+
+    def tearDown(self):
+        self.first.close()
+        self.second.close()
+        shutil.rmtree(self.directory)
+
+    def test_one_lease_at_a_time(self):
+        self.assertEqual((None, True), self.first.claim(FULL_EVENT_URL))
+        self.assertEqual((None, False), self.second.claim(FULL_EVENT_URL))
+        self.first.release(FULL_EVENT_URL)
+        self.assertEqual((None, True), self.second.claim(FULL_EVENT_URL))
+
+    def test_fresh_state_shared(self):
+        self.first.claim(FULL_EVENT_URL)
+        shared = state(20, starts=STARTS)
+        self.first.put(FULL_EVENT_URL, shared)
+        (fields, refresh) = self.second.claim(FULL_EVENT_URL)
+        self.assertFalse(refresh)
+        self.assertEqual(shared, shared._replace(**fields))
+
+    def test_stale_state_refreshed_once(self):
+        self.first.put(FULL_EVENT_URL, state(20, starts=STARTS))
+        later = time.time() + 11
+        with patch('time.time', lambda: later):
+            (fields, refresh) = self.second.claim(FULL_EVENT_URL)
+            self.assertTrue(refresh)
+            self.assertEqual(20, fields['attendee_count'])
+            self.assertFalse(self.first.claim(FULL_EVENT_URL)[1])
+
+    def test_expired_lease_taken_over(self):
+        self.first.claim(FULL_EVENT_URL)
+        later = time.time() + 11
+        with patch('time.time', lambda: later):
+            self.assertTrue(self.second.claim(FULL_EVENT_URL)[1])
+
+    def test_page_retrieved_by_one_instance(self):
+        session = session_manager(
+            ('GET', FULL_EVENT_URL + '$', 
+             {'content': open('event_logged_full_notjoined.html').read()})
+            ).session
+        fake = session.get_adapter(FULL_EVENT_URL)
+        caches = [coucheventjoiner.PageCache(), coucheventjoiner.PageCache()]
+        for cache in caches:
+            cache.state = state(19, starts=STARTS)
+        (first, _) = coucheventjoiner.get_event_page(
+            session, FULL_EVENT_URL, caches[0], shared=self.first)
+        (second, (result, _)) = coucheventjoiner.get_event_page(
+            session, FULL_EVENT_URL, caches[1], shared=self.second)
+        self.assertEqual(1, len(fake.sent))
+        self.assertEqual(coucheventjoiner.Result.ok, result)
+        self.assertEqual(20, second.attendee_count)
+        self.assertEqual(first, second)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import coucheventjoiner
+import unittest
+from benchmarks import standin
+
+EVENT_URL = 'https://www.couchsurfing.org/n/events/standin'
+
+#Real sockets, against the local stand-in server
+class TestStandin(unittest.TestCase):
+
+    def setUp(self):
+        self.state = standin.StandinState(capacity=3, seed=1)
+        self.server = standin.start_server(self.state)
+        self.manager = coucheventjoiner.SessionManager(
+            standin.standin_session(self.server.url),
+            'username',
+            'password')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def watch(self):
+        return coucheventjoiner.EventWatch(self.manager,
+                                           EVENT_URL,
+                                           coucheventjoiner.FixedDelay(10))
+
+    def test_join_when_spot_frees(self):
+        self.manager.login()
+        watch = self.watch()
+        self.assertEqual((coucheventjoiner.Result.retry, 'Event full'),
+                         watch.poll())
+        self.state.events['standin'].attendees -= 1
+        (result, _) = watch.poll()
+        self.assertEqual(coucheventjoiner.Result.ok, result)
+        self.assertEqual(['username'], 
+                         list(self.state.events['standin'].joined))
+        self.assertEqual(coucheventjoiner.Result.abandon, watch.poll()[0])
+
+    def test_relogin_after_session_expiry(self):
+        self.state.session_ttl = 0
+        self.manager.login()
+        watch = self.watch()
+        watch.poll()
+        self.assertEqual(2, self.state.requests['auth'])
+        self.assertEqual(2, self.manager.generation)
+
+if __name__ == '__main__':
+    unittest.main()
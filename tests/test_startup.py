@@ -0,0 +1,52 @@
+import os
+import sys
+import subprocess
+import unittest
+
+MAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#modules too slow to import when only the arguments are checked
+SLOW_MODULES = ['requests', 'lxml', 'cookielib', 'BaseHTTPServer', 'sqlite3']
+
+def loaded_modules(argv):
+    """
+    Modules imported by coucheventjoiner when started with argv. 
+    """
+    code = ('import sys\n'
+            'sys.argv = ["coucheventjoiner.py"] + sys.argv[1:]\n'
+            'import coucheventjoiner\n'
+            'try:\n'
+            '    coucheventjoiner.get_user_values()\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'sys.stderr.write(" ".join(sys.modules))\n')
+    process = subprocess.Popen([sys.executable, '-c', code] + argv,
+                               cwd=MAIN_DIR,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    (_, err) = process.communicate()
+    return err.split()
+
+class TestStartup(unittest.TestCase):
+
+    def assertNoSlowImport(self, argv):
+        modules = loaded_modules(argv)
+        self.assertIn('coucheventjoiner', modules)
+        for module in SLOW_MODULES:
+            self.assertNotIn(module, modules)
+
+    def test_help(self):
+        self.assertNoSlowImport(['--help'])
+
+    def test_invalid_url(self):
+        self.assertNoSlowImport(['https://www.couchsurfing.org/n/places/x',
+                                 'username', 
+                                 'password'])
+
+    def test_valid_arguments(self):
+        self.assertNoSlowImport(['https://www.couchsurfing.org/n/events/x',
+                                 'username', 
+                                 'password'])
+
+if __name__ == '__main__':
+    unittest.main()
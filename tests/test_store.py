@@ -0,0 +1,88 @@
+import coucheventjoiner
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from mock import patch
+from helpers import session_manager
+from test_watchers import FULL_EVENT, FULL_EVENT_URL, FREE_EVENT_URL
+
+class TestWatchStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'watches.db')
+        self.store = coucheventjoiner.WatchStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        self.store.close()
+        self.store = coucheventjoiner.WatchStore(self.path)
+
+    def watch(self, event=FULL_EVENT_URL):
+        delay = coucheventjoiner.AdaptiveDelay(10, 300)
+        return coucheventjoiner.EventWatch(session_manager(FULL_EVENT), 
+                                           event, 
+                                           delay)
+
+    def test_nothing_saved(self):
+        self.assertIsNone(self.store.restore(self.watch()))
+
+    def test_state_survives_restart(self):
+        watch = self.watch()
+        watch.poll()
+        watch.delay.next_delay(watch.cache.state, datetime.datetime.now())
+        watch.cache.etag = '"abc"'
+        self.store.save(watch, 1234.5)
+        self.reopen()
+
+        restored = self.watch()
+        saved = self.store.restore(restored)
+        self.assertEqual(1234.5, saved['next_due'])
+        self.assertEqual(watch.cache.state, restored.cache.state)
+        self.assertEqual('"abc"', restored.cache.etag)
+        self.assertEqual(watch.cache.body_hash, restored.cache.body_hash)
+        self.assertEqual(watch.delay.delay, restored.delay.delay)
+        self.assertEqual(watch.delay.last_count, restored.delay.last_count)
+
+    def test_save_is_batched(self):
+        self.store.save(self.watch(), 1)
+        other = coucheventjoiner.WatchStore(self.path)
+        try:
+            self.assertIsNone(other.load(FULL_EVENT_URL))
+            self.store.flush()
+            self.assertEqual(1, other.load(FULL_EVENT_URL)['next_due'])
+        finally:
+            other.close()
+
+    def test_done_event_is_skipped(self):
+        self.store.save(self.watch(FREE_EVENT_URL), None, 
+                        coucheventjoiner.Result.ok)
+        with patch('coucheventjoiner.poll_event') as poll:
+            watcher = coucheventjoiner.watch_event(session_manager(), 
+                                                   FREE_EVENT_URL, 10,
+                                                   store=self.store)
+            self.assertEqual([], list(watcher))
+        self.assertFalse(poll.called)
+
+    def test_watch_resumes_at_next_due(self):
+        self.store.save(self.watch(), time.time() + 100)
+        watcher = coucheventjoiner.watch_event(session_manager(), 
+                                               FULL_EVENT_URL, 10, 
+                                               store=self.store)
+        self.assertAlmostEqual(100, next(watcher), delta=1)
+        watcher.close()
+
+    def test_forget(self):
+        self.store.save(self.watch(), 1)
+        self.store.flush()
+        self.store.forget(FULL_EVENT_URL)
+        self.assertIsNone(self.store.load(FULL_EVENT_URL))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import coucheventjoiner
+import unittest
+from mock import patch
+from helpers import FakeClock, session_manager
+
+FREE_EVENT_URL = 'https://www.couchsurfing.org/n/events/free'
+FULL_EVENT_URL = 'https://www.couchsurfing.org/n/events/full'
+MISSING_EVENT_URL = 'https://www.couchsurfing.org/n/events/missing'
+BROKEN_EVENT_URL = 'https://www.couchsurfing.org/n/events/broken'
+
+def free_event_page(request):
+    return {'content': open('event_logged_freespot_notjoined.html').read()}
+
+def full_event_page(request):
+    return {'content': open('event_logged_full_notjoined.html').read()}
+
+def unreadable_counter_page(request):
+    """Logged in, full event page whose attendee count can't be read"""
+    page = open('event_logged_full_notjoined.html').read()
+    return {'content': page.replace("'attendee_count'>20<", 
+                                    "'attendee_count'>twenty<")}
+
+#routes of coucheventjoiner.FakeAdapter
+FREE_EVENT = ('GET', FREE_EVENT_URL + '$', free_event_page)
+FULL_EVENT = ('GET', FULL_EVENT_URL + '$', full_event_page)
+MISSING_EVENT = ('GET', MISSING_EVENT_URL + '$', {'status_code': 404})
+BROKEN_EVENT = ('GET', BROKEN_EVENT_URL + '$', unreadable_counter_page)
+JOIN_OK = ('POST', r'.*/join$', {'content': '{}'})
+JOIN_FULL = ('POST', r'.*/join$', 
+             {'content': '{"error":"This event is full."}'})
+
+class TestWatchers(unittest.TestCase):
+
+    def test_poll_joins_free_event(self):
+        (result, _) = coucheventjoiner.poll_event(
+            session_manager(FREE_EVENT, JOIN_OK), FREE_EVENT_URL)
+        self.assertEqual(coucheventjoiner.Result.ok, result)
+
+    def test_poll_streamed_free_event(self):
+        (result, _) = coucheventjoiner.poll_event(
+            session_manager(FREE_EVENT, JOIN_OK), FREE_EVENT_URL, stream=True)
+        self.assertEqual(coucheventjoiner.Result.ok, result)
+
+    def test_poll_full_event(self):
+        (result, _) = coucheventjoiner.poll_event(session_manager(FULL_EVENT),
+                                                 FULL_EVENT_URL)
+        self.assertEqual(coucheventjoiner.Result.retry, result)
+
+    def test_probe_join(self):
+        manager = session_manager(FULL_EVENT, JOIN_FULL)
+        watch = coucheventjoiner.EventWatch(manager,
+                                            FULL_EVENT_URL,
+                                            coucheventjoiner.FixedDelay(10),
+                                            probe_every=3)
+        results = [watch.poll()[0] for _ in range(4)]
+        self.assertEqual([coucheventjoiner.Result.retry] * 4, results)
+        sent = manager.session.get_adapter(FULL_EVENT_URL).sent
+        self.assertEqual(['GET', 'POST', 'POST', 'GET'], 
+                         [request.method for request in sent])
+
+    def test_probe_join_joins(self):
+        manager = session_manager(FULL_EVENT)
+        watch = coucheventjoiner.EventWatch(manager,
+                                            FULL_EVENT_URL,
+                                            coucheventjoiner.FixedDelay(10),
+                                            probe_every=3)
+        watch.poll()
+        manager.session.get_adapter(FULL_EVENT_URL).routes = [JOIN_OK]
+        (result, _) = watch.poll()
+        self.assertEqual(coucheventjoiner.Result.ok, result)
+
+    def test_probe_redirected_to_login(self):
+        manager = session_manager(FULL_EVENT)
+        watch = coucheventjoiner.EventWatch(manager,
+                                            FULL_EVENT_URL,
+                                            coucheventjoiner.FixedDelay(10),
+                                            probe_every=3)
+        watch.poll()
+        fake = manager.session.get_adapter(FULL_EVENT_URL)
+        #the session expired since the page was retrieved
+        login_url = 'https://www.couchsurfing.org/n/login'
+        fake.routes = [('POST', r'.*/join$', 
+                        {'status_code': 302, 
+                         'headers': {'Location': login_url}}),
+                       ('GET', login_url, {'content': '<html></html>'}),
+                       FULL_EVENT]
+        (result, _) = watch.poll()
+        self.assertEqual(coucheventjoiner.Result.retry, result)
+        watch.poll()
+        self.assertEqual([('GET', FULL_EVENT_URL),
+                          ('POST', FULL_EVENT_URL + '/join'),
+                          ('GET', login_url),
+                          ('GET', FULL_EVENT_URL)],
+                         [(request.method, request.url) 
+                          for request in fake.sent])
+
+    @patch('time.sleep')
+    def test_watch_events(self, sleep_mock):
+        coucheventjoiner.watch_events(
+            session_manager(FREE_EVENT, MISSING_EVENT, JOIN_OK),
+            [FREE_EVENT_URL, MISSING_EVENT_URL],
+            coucheventjoiner.MIN_RETRY_DELAY)
+        self.assertFalse(sleep_mock.called)
+
+    def test_unparsable_page_only_retries_its_event(self):
+        #the broken page is fixed on the next poll, and shows the event over
+        pages = iter([unreadable_counter_page(None), 
+                      {'content': open('event_attending_over.html').read()}])
+        manager = session_manager(
+            ('GET', BROKEN_EVENT_URL + '$', lambda request: next(pages)),
+            FREE_EVENT, 
+            JOIN_OK)
+        clock = FakeClock()
+        with patch('time.time', clock.time), patch('time.sleep', clock.sleep):
+            coucheventjoiner.watch_events(manager,
+                                          [BROKEN_EVENT_URL, FREE_EVENT_URL],
+                                          coucheventjoiner.MIN_RETRY_DELAY)
+        sent = manager.session.get_adapter(FREE_EVENT_URL).sent
+        self.assertEqual([('GET', BROKEN_EVENT_URL), 
+                          ('GET', FREE_EVENT_URL), 
+                          ('POST', FREE_EVENT_URL + '/join'),
+                          ('GET', BROKEN_EVENT_URL)],
+                         [(request.method, request.url) for request in sent])
+
+if __name__ == '__main__':
+    unittest.main()